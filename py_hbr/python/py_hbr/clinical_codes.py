@@ -3,18 +3,70 @@
 ##
 
 from py_hbr import _lib_name
+import functools
 import os
-import pandas
+
+
+def _record_batch_to_pandas(batch):
+    """
+    Convert a pyarrow.RecordBatch of string columns (as returned by
+    the Rust functions) to a pandas dataframe, keeping the strings in
+    Arrow memory (string[pyarrow] dtype) instead of converting every
+    value to a Python str object.
+    """
+    # pandas and pyarrow are imported when they are first needed,
+    # so that the group names can be read without importing them
+    import pandas
+    import pyarrow
+
+    string_dtype = pandas.StringDtype("pyarrow")
+    return batch.to_pandas(types_mapper={pyarrow.string(): string_dtype}.get)
+
+
+def _codes_file_mtime(codes_file_path):
+    """
+    Get the modification time of the codes file (used as part of the
+    cache keys below), raising a ValueError if the file does not exist.
+    This is a single stat of the file, which also serves as the check
+    that the file exists; errors opening the file are raised by the
+    Rust functions.
+    """
+    try:
+        return os.stat(codes_file_path).st_mtime
+    except FileNotFoundError:
+        raise ValueError(f"The codes file '{codes_file_path}' does not exist")
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_groups_in_codes_file(codes_file_path, mtime):
+    """
+    Parse the codes file and return the group names as a tuple.
+
+    The YAML parsing (in Rust) is the slow part of reading a codes
+    file, so the result is memoized. The modification time is part
+    of the cache key so that changes made to the file (e.g. using the
+    codes editor) are picked up on the next call.
+    """
+    return tuple(_lib_name.rust_get_groups_in_codes_file(codes_file_path))
 
 
 def get_groups_in_codes_file(codes_file_path):
     """
     Get the list of valid group names defined in a codes file
     """
-    if not os.path.exists(codes_file_path):
-        raise ValueError(f"The codes file '{codes_file_path}' does not exist")
+    mtime = _codes_file_mtime(codes_file_path)
+    return list(_cached_groups_in_codes_file(codes_file_path, mtime))
 
-    return _lib_name.rust_get_groups_in_codes_file(codes_file_path)
+
+@functools.lru_cache(maxsize=256)
+def _cached_codes_in_group(codes_file_path, mtime, group):
+    """
+    Get the name and docs columns for a code group as a
+    pyarrow.RecordBatch, memoized in the same way as
+    _cached_groups_in_codes_file. Record batches are immutable,
+    so the cached value cannot be modified by the caller.
+    """
+    return _lib_name.rust_get_codes_in_group_arrow(codes_file_path, group)
 
 
 def get_codes_in_group(codes_file_path, group):
@@ -30,14 +82,39 @@ def get_codes_in_group(codes_file_path, group):
     """
 
     # This will also check if the codes file exists
-    valid_groups = _lib_name.rust_get_groups_in_codes_file(codes_file_path)
+    mtime = _codes_file_mtime(codes_file_path)
+    valid_groups = _cached_groups_in_codes_file(codes_file_path, mtime)
 
     if not group in valid_groups:
         raise ValueError(
             f"code group '{group}' is not present in codes file '{codes_file_path}'"
         )
 
-    return pandas.DataFrame(_lib_name.rust_get_codes_in_group(codes_file_path, group))
+    return _record_batch_to_pandas(_cached_codes_in_group(codes_file_path, mtime, group))
+
+@functools.lru_cache(maxsize=32)
+def _cached_all_codes(codes_file_path, mtime):
+    """
+    Get the name, docs and group columns for every code group in
+    the codes file as a pyarrow.RecordBatch, memoized in the same
+    way as _cached_codes_in_group.
+    """
+    return _lib_name.rust_get_all_codes_arrow(codes_file_path)
+
+
+def get_all_codes_in_codes_file(codes_file_path):
+    """
+    Get a pandas dataframe of all the codes in all the groups defined
+    in a codes file.
+
+    The dataframe contains three columns: "name" and "docs" (as for
+    get_codes_in_group), and "group", the name of the group containing
+    the code. A code in several groups appears once per group. This
+    parses the codes file once, so it is much faster than calling
+    get_codes_in_group for each group.
+    """
+    mtime = _codes_file_mtime(codes_file_path)
+    return _record_batch_to_pandas(_cached_all_codes(codes_file_path, mtime))
 
 class ClinicalCode:
     def __init__(self, name, docs):
@@ -58,6 +135,13 @@ class ClinicalCodeParser:
             diagnosis_codes_file_path, procedure_codes_file_path
         )
 
+        # Results of find_exact, keyed by (code, diagnosis_or_procedure).
+        # The same few codes are looked up many times when parsing
+        # a table of episodes, so most lookups are answered here
+        # without calling into Rust. Codes with no match are stored
+        # as None, so that misses are also only searched for once.
+        self._cache = {}
+
     def find_exact(self, code, diagnosis_or_procedure):
         '''
         Find an exact match for the diagnosis or procedure code
@@ -66,8 +150,59 @@ class ClinicalCodeParser:
         Pass "diagnosis" or "procedure" as the final argument to
         parse either an ICD-10 or OPCS-4 code.
         '''
-        code = self._parser.find_exact_diagnosis(code, diagnosis_or_procedure)
-        return ClinicalCode(code[0], code[1])
-
-
-
+        key = (code, diagnosis_or_procedure)
+        if key not in self._cache:
+            try:
+                self._cache[key] = ClinicalCode(
+                    *self._parser.find_exact_diagnosis(code, diagnosis_or_procedure)
+                )
+            except ValueError:
+                if diagnosis_or_procedure not in ("diagnosis", "procedure"):
+                    raise
+                self._cache[key] = None
+
+        clinical_code = self._cache[key]
+        if clinical_code is None:
+            raise ValueError(f"No match for {code} found in {diagnosis_or_procedure} tree")
+        return clinical_code
+
+    def find_exact_many(self, codes, diagnosis_or_procedure):
+        '''
+        Find exact matches for every code in codes (a list, numpy
+        array or pandas Series of strings), which are all diagnosis
+        codes or all procedure codes. Returns a pandas dataframe with
+        one row per element of codes, and two columns "name" and "docs"
+        for the matched code. Both columns are None for codes which do
+        not match anything in the code tree (instead of raising a
+        ValueError as find_exact does).
+
+        Each distinct code that has not been looked up before is
+        searched for once, in a single call into Rust, and the results
+        are shared with find_exact.
+        '''
+        import pandas
+
+        if diagnosis_or_procedure not in ("diagnosis", "procedure"):
+            raise ValueError(
+                f"Must pass one of 'diagnosis' or 'procedure', not '{diagnosis_or_procedure}'"
+            )
+
+        codes = list(codes)
+        new_codes = [
+            code
+            for code in dict.fromkeys(codes)
+            if (code, diagnosis_or_procedure) not in self._cache
+        ]
+        if len(new_codes) > 0:
+            names, docs = self._parser.find_exact_many(new_codes, diagnosis_or_procedure)
+            for code, name, doc in zip(new_codes, names, docs):
+                clinical_code = None if name is None else ClinicalCode(name, doc)
+                self._cache[(code, diagnosis_or_procedure)] = clinical_code
+
+        matches = [self._cache[(code, diagnosis_or_procedure)] for code in codes]
+        return pandas.DataFrame(
+            {
+                "name": [None if m is None else m.name for m in matches],
+                "docs": [None if m is None else m.docs for m in matches],
+            }
+        )
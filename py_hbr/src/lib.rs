@@ -1,9 +1,15 @@
 //! The main Rust-language interface layer between rust_hbr (the Rust crate)
 //! and py_hbr (the Python package).
 
+use arrow::{
+    array::{ArrayRef, StringArray},
+    pyarrow::ToPyArrow,
+    record_batch::RecordBatch,
+};
 use pyo3::{exceptions::PyValueError, prelude::*};
+use rayon::prelude::*;
 use rust_hbr::{clinical_code::ClinicalCodeStore, clinical_code_tree::ClinicalCodeTree};
-use std::collections::HashMap;
+use std::{collections::HashMap, sync::Arc};
 
 /// Class for parsing diagnosis and procedure codes by searching
 /// for them in a codes file. Used to check code validity and
@@ -18,18 +24,27 @@ struct RustClinicalCodeParser {
 #[pymethods]
 impl RustClinicalCodeParser {
     #[new]
-    fn new(diagnosis_codes_file_path: &str, procedure_codes_file_path: &str) -> PyResult<Self> {
-        let diagnosis_code_tree = if let Ok(f) = std::fs::File::open(diagnosis_codes_file_path) {
-            ClinicalCodeTree::from_reader(f)
-        } else {
-            return Err(PyValueError::new_err("Failed to open diagnosis codes file"));
-        };
+    fn new(
+        py: Python,
+        diagnosis_codes_file_path: &str,
+        procedure_codes_file_path: &str,
+    ) -> PyResult<Self> {
+        // Parsing the codes files does not need the GIL
+        let (diagnosis_code_tree, procedure_code_tree) = py.allow_threads(|| {
+            let diagnosis_code_tree = if let Ok(f) = std::fs::File::open(diagnosis_codes_file_path) {
+                ClinicalCodeTree::from_reader(f)
+            } else {
+                return Err(PyValueError::new_err("Failed to open diagnosis codes file"));
+            };
 
-        let procedure_code_tree = if let Ok(f) = std::fs::File::open(procedure_codes_file_path) {
-            ClinicalCodeTree::from_reader(f)
-        } else {
-            return Err(PyValueError::new_err("Failed to open procedure codes file"));
-        };
+            let procedure_code_tree = if let Ok(f) = std::fs::File::open(procedure_codes_file_path) {
+                ClinicalCodeTree::from_reader(f)
+            } else {
+                return Err(PyValueError::new_err("Failed to open procedure codes file"));
+            };
+
+            Ok((diagnosis_code_tree, procedure_code_tree))
+        })?;
 
         let mut code_store = ClinicalCodeStore::new();
 
@@ -73,6 +88,56 @@ impl RustClinicalCodeParser {
             )))
         }
     }
+
+    /// Find exact matches for a list of diagnosis or procedure codes
+    /// in one call. Returns a tuple of two lists (code names and docs)
+    /// of the same length as codes, containing None where a code does
+    /// not match anything in the code tree. The diagnosis_or_procedure
+    /// argument is the same as for find_exact_diagnosis. The GIL is
+    /// released while searching the tree.
+    fn find_exact_many(
+        &mut self,
+        py: Python,
+        codes: Vec<String>,
+        diagnosis_or_procedure: &str,
+    ) -> PyResult<(Vec<Option<String>>, Vec<Option<String>>)> {
+        let code_tree = if diagnosis_or_procedure == "diagnosis" {
+            &self.diagnosis_code_tree
+        } else if diagnosis_or_procedure == "procedure" {
+            &self.procedure_code_tree
+        } else {
+            return Err(PyValueError::new_err(format!(
+                "Must pass one of 'diagnosis' or 'procedure', not '{diagnosis_or_procedure}'"
+            )))
+        };
+        let code_store = &mut self.code_store;
+        Ok(py.allow_threads(|| {
+            let mut names = Vec::with_capacity(codes.len());
+            let mut docs = Vec::with_capacity(codes.len());
+            for code in codes {
+                if let Ok(matched_code_ref) = code_tree.find_exact(code, code_store) {
+                    let matched_code = code_store
+                        .clinical_code_from(&matched_code_ref)
+                        .expect("If code was matched, expected code ref to be valid");
+                    names.push(Some(matched_code.name().to_string()));
+                    docs.push(Some(matched_code.docs().to_string()));
+                } else {
+                    names.push(None);
+                    docs.push(None);
+                }
+            }
+            (names, docs)
+        }))
+    }
+}
+
+/// Open and parse a codes file, returning a Python ValueError
+/// (instead of panicking) if the file cannot be opened.
+fn read_code_tree(codes_file_path: &str) -> PyResult<ClinicalCodeTree> {
+    let f = std::fs::File::open(codes_file_path).map_err(|e| {
+        PyValueError::new_err(format!("Failed to open codes file '{codes_file_path}': {e}"))
+    })?;
+    Ok(ClinicalCodeTree::from_reader(f))
 }
 
 /// Get the clinical codes in a particular code group defined
@@ -83,14 +148,25 @@ impl RustClinicalCodeParser {
 /// * name: the name of the code in the group (e.g. A01.0)
 /// * docs: the description of the code
 ///
-/// TODO: figure out a good way to handle errors.
+/// Raises a ValueError if the codes file cannot be opened.
 ///
 /// @export
 #[pyfunction]
-fn rust_get_codes_in_group(codes_file_path: &str, group: &str) -> HashMap<String, Vec<String>> {
-    let f = std::fs::File::open(codes_file_path).expect("Failed to open codes file");
+fn rust_get_codes_in_group(
+    py: Python,
+    codes_file_path: &str,
+    group: &str,
+) -> PyResult<HashMap<String, Vec<String>>> {
+    py.allow_threads(|| read_codes_in_group(codes_file_path, group))
+}
 
-    let code_tree = ClinicalCodeTree::from_reader(f);
+/// Implementation of rust_get_codes_in_group, which does not need
+/// the GIL (so that it can be run inside Python::allow_threads).
+fn read_codes_in_group(
+    codes_file_path: &str,
+    group: &str,
+) -> PyResult<HashMap<String, Vec<String>>> {
+    let code_tree = read_code_tree(codes_file_path)?;
     let mut code_store = ClinicalCodeStore::new();
 
     let clinical_code_refs = code_tree
@@ -110,7 +186,112 @@ fn rust_get_codes_in_group(codes_file_path: &str, group: &str) -> HashMap<String
     let mut code_list = HashMap::new();
     code_list.insert(format!("name"), name);
     code_list.insert(format!("docs"), docs);
-    code_list
+    Ok(code_list)
+}
+
+/// Get all the clinical codes in all the code groups defined
+/// in a codes file.
+///
+/// The result is a named list (intended as a dataframe) with the
+/// columns:
+/// * name: the name of the code (e.g. A01.0)
+/// * docs: the description of the code
+/// * group: the name of the group containing the code
+///
+/// A code appears once for each group that contains it. The codes
+/// file is only parsed once, instead of once per group as happens
+/// when calling rust_get_codes_in_group for every group. The groups
+/// are then walked in parallel, each with its own code store.
+///
+#[pyfunction]
+fn rust_get_all_codes(py: Python, codes_file_path: &str) -> PyResult<HashMap<String, Vec<String>>> {
+    py.allow_threads(|| read_all_codes(codes_file_path))
+}
+
+/// Implementation of rust_get_all_codes, which does not need the GIL.
+fn read_all_codes(codes_file_path: &str) -> PyResult<HashMap<String, Vec<String>>> {
+    let code_tree = read_code_tree(codes_file_path)?;
+
+    // Sort the groups so that the row order does not depend on
+    // the (random) HashSet iteration order
+    let mut groups: Vec<&String> = code_tree.groups().iter().collect();
+    groups.sort();
+
+    let rows: Vec<(String, String, String)> = groups
+        .par_iter()
+        .flat_map_iter(|group| {
+            let mut code_store = ClinicalCodeStore::new();
+            let clinical_code_refs = code_tree
+                .codes_in_group(group, &mut code_store)
+                .expect("Should succeed, group is present");
+            clinical_code_refs
+                .iter()
+                .map(|code_ref| {
+                    let clinical_code = code_store
+                        .clinical_code_from(code_ref)
+                        .expect("Clinical code should be present");
+                    (
+                        clinical_code.name().clone(),
+                        clinical_code.docs().clone(),
+                        group.to_string(),
+                    )
+                })
+                .collect::<Vec<_>>()
+        })
+        .collect();
+
+    let mut name = Vec::with_capacity(rows.len());
+    let mut docs = Vec::with_capacity(rows.len());
+    let mut group_name = Vec::with_capacity(rows.len());
+    for (code_name, code_docs, code_group) in rows {
+        name.push(code_name);
+        docs.push(code_docs);
+        group_name.push(code_group);
+    }
+
+    let mut code_list = HashMap::new();
+    code_list.insert(format!("name"), name);
+    code_list.insert(format!("docs"), docs);
+    code_list.insert(format!("group"), group_name);
+    Ok(code_list)
+}
+
+/// Convert a named list of string columns (as returned by
+/// rust_get_codes_in_group or rust_get_all_codes) into a
+/// pyarrow.RecordBatch, keeping the columns in the order given.
+/// The strings are copied once into Arrow buffers, instead of
+/// being converted to one Python object each.
+fn code_list_to_pyarrow(
+    py: Python,
+    mut code_list: HashMap<String, Vec<String>>,
+    columns: &[&str],
+) -> PyResult<PyObject> {
+    let mut arrays: Vec<(&str, ArrayRef)> = Vec::new();
+    for column in columns {
+        let values = code_list
+            .remove(*column)
+            .expect("Column should be present in code list");
+        arrays.push((*column, Arc::new(StringArray::from(values)) as ArrayRef));
+    }
+    let batch = RecordBatch::try_from_iter(arrays)
+        .map_err(|e| PyValueError::new_err(format!("Failed to build record batch: {e}")))?;
+    batch.to_pyarrow(py)
+}
+
+/// Same as rust_get_codes_in_group, but returns a pyarrow.RecordBatch
+/// with columns name and docs.
+#[pyfunction]
+fn rust_get_codes_in_group_arrow(py: Python, codes_file_path: &str, group: &str) -> PyResult<PyObject> {
+    let code_list = py.allow_threads(|| read_codes_in_group(codes_file_path, group))?;
+    code_list_to_pyarrow(py, code_list, &["name", "docs"])
+}
+
+/// Same as rust_get_all_codes, but returns a pyarrow.RecordBatch
+/// with columns name, docs and group.
+#[pyfunction]
+fn rust_get_all_codes_arrow(py: Python, codes_file_path: &str) -> PyResult<PyObject> {
+    let code_list = py.allow_threads(|| read_all_codes(codes_file_path))?;
+    code_list_to_pyarrow(py, code_list, &["name", "docs", "group"])
 }
 
 /// Get the code groups defined in a codes file
@@ -120,11 +301,12 @@ fn rust_get_codes_in_group(codes_file_path: &str, group: &str) -> HashMap<String
 /// all the code groups using rust_get_codes_in_group.
 ///
 #[pyfunction]
-fn rust_get_groups_in_codes_file(codes_file_path: &str) -> Vec<String> {
-    let f = std::fs::File::open(codes_file_path).expect("Failed to open codes file");
-    let code_tree = ClinicalCodeTree::from_reader(f);
-    // get the code groups and return here
-    code_tree.groups().iter().cloned().collect()
+fn rust_get_groups_in_codes_file(py: Python, codes_file_path: &str) -> PyResult<Vec<String>> {
+    py.allow_threads(|| {
+        let code_tree = read_code_tree(codes_file_path)?;
+        // get the code groups and return here
+        Ok(code_tree.groups().iter().cloned().collect())
+    })
 }
 
 /// A Python module implemented in Rust.
@@ -133,6 +315,9 @@ fn rust_get_groups_in_codes_file(codes_file_path: &str) -> Vec<String> {
 fn my_lib_name(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(rust_get_codes_in_group, m)?)?;
     m.add_function(wrap_pyfunction!(rust_get_groups_in_codes_file, m)?)?;
+    m.add_function(wrap_pyfunction!(rust_get_all_codes, m)?)?;
+    m.add_function(wrap_pyfunction!(rust_get_codes_in_group_arrow, m)?)?;
+    m.add_function(wrap_pyfunction!(rust_get_all_codes_arrow, m)?)?;
     m.add_class::<RustClinicalCodeParser>()?;
     Ok(())
 }
@@ -12,9 +12,57 @@
 # (see stability.py).
 
 import numpy as np
-from sklearn.calibration import calibration_curve
 
 
+def get_calibration_bin_sums(probs, y_test, n_bins):
+    """
+    For every model (column of probs), compute the per-bin totals
+    needed for a calibration curve, using the same uniform bins as
+    sklearn.calibration.calibration_curve. y_test must contain 0/1
+    outcomes. The result is a tuple of three arrays (bin_sums,
+    bin_true, bin_total), each with one row per bin and one column
+    per model, containing the sum of predicted probabilities, the
+    number of positive outcomes, and the number of samples.
+
+    All models are handled at once: the bin index of every element
+    of probs is found in one np.searchsorted call, and each column's
+    indices are offset so that a single np.bincount accumulates all
+    the columns together.
+    """
+    num_models = probs.shape[1]
+    bin_edges = np.linspace(0, 1, n_bins + 1)
+    bin_index = np.searchsorted(bin_edges[1:-1], probs)
+    bin_index += n_bins * np.arange(num_models)
+    bin_index = bin_index.ravel()
+
+    y_test = np.broadcast_to(np.asarray(y_test, dtype=float)[:, None], probs.shape)
+    length = n_bins * num_models
+    bin_sums = np.bincount(bin_index, weights=probs.ravel(), minlength=length)
+    bin_true = np.bincount(bin_index, weights=y_test.ravel(), minlength=length)
+    bin_total = np.bincount(bin_index, minlength=length)
+
+    shape = (num_models, n_bins)
+    return (
+        bin_sums.reshape(shape).T,
+        bin_true.reshape(shape).T,
+        bin_total.reshape(shape).T,
+    )
+
+def get_calibration_curve(y_test, prob, n_bins):
+    """
+    Compute the calibration curve for one model, giving the same
+    result as sklearn.calibration.calibration_curve with the default
+    uniform strategy (i.e. returns prob_true, prob_pred for the
+    non-empty bins). y_test must contain 0/1 outcomes.
+    """
+    bin_sums, bin_true, bin_total = get_calibration_bin_sums(
+        prob[:, None], y_test, n_bins
+    )
+    nonzero = bin_total[:, 0] != 0
+    prob_true = bin_true[nonzero, 0] / bin_total[nonzero, 0]
+    prob_pred = bin_sums[nonzero, 0] / bin_total[nonzero, 0]
+    return prob_true, prob_pred
+
 def get_bootstrapped_calibration(probs, y_test, n_bins):
     """
     Get the calibration curves for all models (whose probability
@@ -24,14 +72,24 @@ def get_bootstrapped_calibration(probs, y_test, n_bins):
     of probs). Each pair contains the vector of x- and y-coordinates
     of the calibration curve.
 
-    Testing: not yet tested
+    The bin totals for all the models are computed together by
+    get_calibration_bin_sums; only the removal of empty bins (which
+    differ between models) is done per column.
+
+    Testing: test_bootstrapped_calibration
     """
+    bin_sums, bin_true, bin_total = get_calibration_bin_sums(probs, y_test, n_bins)
+    nonzero = bin_total != 0
+    # Empty bins are divided by one, and then dropped below
+    denominator = np.maximum(bin_total, 1)
+    prob_true = bin_true / denominator
+    prob_pred = bin_sums / denominator
+
     curves = []
     for n in range(probs.shape[1]):
-        # Reverse because it is more convenient to have the x-axis first
-        curves.append(
-            tuple(reversed(calibration_curve(y_test, probs[:, n], n_bins=n_bins)))
-        )
+        # The x-axis (predicted probability) comes first
+        keep = nonzero[:, n]
+        curves.append((prob_pred[keep, n], prob_true[keep, n]))
     return curves
 
 def get_average_calibration_error(probs, y_test, n_bins):
@@ -59,6 +117,9 @@ def get_average_calibration_error(probs, y_test, n_bins):
     Testing: not yet tested.
     """
     
+    # Imported here so that the rest of this module does not need sklearn
+    from sklearn.calibration import calibration_curve
+
     # There is one estimated calibration error for each model (the model under
     # test and all the bootstrap models). These will be averaged at the end
     estimated_calibration_errors = []
@@ -110,6 +171,31 @@ def plot_calibration_curves(ax, curves, title = "Calibration-stability curves"):
     ax.set_ylabel("Fraction of positives")
 
 
+def get_prediction_bin_counts(probs, n_bins):
+    """
+    Count the number of predicted probabilities falling in each of
+    n_bins equal-width bins on [0, 1], separately for each model
+    (column of probs). The result has one row per bin and one column
+    per model, and matches calling np.histogram on each column (the
+    last bin includes probability 1).
+
+    Since the bins are uniform, the bin index is computed directly
+    from the probability, and all the columns are counted in a single
+    np.bincount call (offsetting each column's bin indices so that
+    they do not overlap). The probabilities are binned in float32,
+    which halves the memory traffic over the (large) matrix of
+    bootstrapped predictions; this only affects which bin a value
+    within about 1e-7 of a bin edge is placed in, which makes no
+    visible difference to the plot.
+    """
+    num_models = probs.shape[1]
+    probs = probs.astype(np.float32, copy=False)
+    bin_index = np.minimum((probs * np.float32(n_bins)).astype(np.intp), n_bins - 1)
+    bin_index += n_bins * np.arange(num_models)
+    counts = np.bincount(bin_index.ravel(), minlength=n_bins * num_models)
+    return counts.reshape(num_models, n_bins).T
+
+
 def plot_prediction_distribution(ax, probs, n_bins):
     """
     Plot the distribution of predicted probabilities over the models as
@@ -122,12 +208,9 @@ def plot_prediction_distribution(ax, probs, n_bins):
     up and down (so 2*sd in total)
     """
     bin_edges = np.linspace(0, 1, n_bins + 1)
-    freqs = []
-    for j in range(probs.shape[1]):
-        f, _ = np.histogram(probs[:, j], bins=bin_edges)
-        freqs.append(f)
-    means = np.mean(freqs, axis=0)
-    sds = np.std(freqs, axis=0)
+    freqs = get_prediction_bin_counts(probs, n_bins)
+    means = np.mean(freqs, axis=1)
+    sds = np.std(freqs, axis=1)
 
     bin_centers = (bin_edges[1:] + bin_edges[:-1]) / 2
 
@@ -1,7 +1,11 @@
 import pandas as pd
-from py_hbr.clinical_codes import get_codes_in_group, get_groups_in_codes_file
+from py_hbr.clinical_codes import get_codes_in_group, get_all_codes_in_codes_file
 import re
 
+# Matches the characters removed from codes when they are normalised
+# (whitespace, dots and any other non-word characters)
+non_word_regex = re.compile(r'\W+')
+
 def get_single_code_group(codes_file, code_group, diagnosis_or_procedure):
     '''
     Helper function to get the list of codes in a group, and append
@@ -25,9 +29,28 @@ def normalise_code(code):
     Remove all whitespace and any dot character,
     and convert characters in the code to lower case.
     '''
-    alpha_num = re.sub(r'\W+', '', code)
+    alpha_num = non_word_regex.sub('', code)
     return alpha_num.lower()
 
+def normalise_codes(codes):
+    '''
+    Vectorised version of normalise_code, which applies the same
+    normalisation to every element of a pandas Series of codes.
+
+    The same code appears many times in a column of codes, so the
+    distinct codes are found first (using pd.factorize), and only
+    those are normalised (using the pandas string methods). The
+    result is then expanded back to the original rows. Missing
+    values stay missing.
+    '''
+    positions, uniques = pd.factorize(codes)
+    normalised = pd.Series(uniques).str.replace(non_word_regex, '', regex=True).str.lower()
+    # Missing values have position -1, which reindex maps to NaN
+    result = normalised.reindex(positions)
+    result.index = codes.index
+    result.name = codes.name
+    return result
+
 def get_code_groups(diagnoses_file, procedures_file):
     '''
     Get a pandas dataframe of all the diagnosis (ICD-10) and procedure (OPCS-4) 
@@ -42,21 +65,16 @@ def get_code_groups(diagnoses_file, procedures_file):
      Note that the same code can appear in multiple rows, when it is in
      multiple groups (one row per group).
      '''
-    dfs = []
-
-    # Get all diagnosis groups
-    diagnoses_groups = get_groups_in_codes_file(diagnoses_file)
-    for group in diagnoses_groups:
-        dfs.append(get_single_code_group(diagnoses_file, group, "diagnosis"))
-
-    # Get all procedures groups
-    procedures_groups = get_groups_in_codes_file(procedures_file)
-    for group in procedures_groups:
-        dfs.append(get_single_code_group(procedures_file, group, "procedure"))
-
-    df = pd.concat(dfs)
+    # Each codes file is parsed once, returning all groups together
+    diagnoses = get_all_codes_in_codes_file(diagnoses_file)
+    procedures = get_all_codes_in_codes_file(procedures_file)
+    df = pd.concat([diagnoses, procedures], ignore_index=True)
+    df["type"] = pd.Categorical.from_codes(
+        [0] * len(diagnoses) + [1] * len(procedures),
+        categories=["diagnosis", "procedure"],
+    )
 
     # Remove dots and whitespace from all codes and convert to lowercase
-    df["name"] = df["name"].transform(normalise_code)
+    df["name"] = normalise_codes(df["name"])
 
-    return df
\ No newline at end of file
+    return df
@@ -3,9 +3,28 @@
 import sqlalchemy as sql
 import pandas as pd
 import time
+import re
+import string
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import connectorx as cx
+from code_group_counts import get_code_groups
 
 con = sql.create_engine("mssql+pyodbc://xsw")
+connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
+
+def time_fetch(fetch, *args, **kwargs):
+    """
+    Call fetch(*args, **kwargs), print the time it took,
+    and return the result. Used for all the benchmarks below.
+    """
+    start = time.time()
+    result = fetch(*args, **kwargs)
+    stop = time.time()
+    print(f"Time to fetch data: {stop - start}")
+    return result
 
 
 # 1. Comparing pandas and polars
@@ -17,44 +36,35 @@ con = sql.create_engine("mssql+pyodbc://xsw")
 
 # 34 s from UHBW, 7,356,371 rows (spells)
 # 22 s from home
-start = time.time()
-raw_spells = pd.read_sql(
-    "select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_spell_001", con
+raw_spells = time_fetch(
+    pd.read_sql, "select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_spell_001", con
 )
-stop = time.time()
-stop - start
 
 # 48 s from UHBW, 11,051,315 rows (episodes)
 # 45 s from home
-start = time.time()
-raw_episodes = pd.read_sql("select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_001", con)
-stop = time.time()
-stop - start
+raw_episodes = time_fetch(
+    pd.read_sql, "select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_001", con
+)
 
 # Using polars
 
 # Old method (polars 0.18, deprecated)
 # 58 s from UHBW, 7,356,371 rows (spells)
 # 29 s from home
-connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
-start = time.time()
-raw_spells = pl.read_database(
+raw_spells = time_fetch(
+    pl.read_database,
     "select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_spell_001",
     connection=connection_uri,
 )
-stop = time.time()
-stop - start
 
 # Old method (polars 0.18, deprecated)
 # 97 s from UHBW, 11,051,315 rows (episodes), deprecated
 # 44 s from home
-connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
-start = time.time()
-raw_episodes = pl.read_database(
-    "select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_001", connection=connection_uri
+raw_episodes = time_fetch(
+    pl.read_database,
+    "select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_001",
+    connection=connection_uri,
 )
-stop = time.time()
-stop - start
 
 # Not sure why the two newer methods below don't return all
 # the data. Turns out that if you specify the partition_on
@@ -63,31 +73,25 @@ stop - start
 
 # New method (polars 0.19, uses connectorx)
 # 48 s from home, 7,356,371 (7,177,052 when using partition)
-connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
-start = time.time()
-raw_spells = pl.read_database_uri(
+raw_spells = time_fetch(
+    pl.read_database_uri,
     query="select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_spell_001",
     uri=connection_uri,
     engine="connectorx",
     # partition_on="aimtc_pseudo_nhs",
     # partition_num=10,
 )
-stop = time.time()
-stop - start
 
 # New method (polars 0.19, uses connectorx)
 # 37 s from home, 11,051,315 (10,810,725 when using partition)
-connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
-start = time.time()
-raw_episodes = pl.read_database_uri(
+raw_episodes = time_fetch(
+    pl.read_database_uri,
     query="select aimtc_pseudo_nhs from abi.dbo.vw_apc_sem_001",
     uri=connection_uri,
     engine="connectorx",
     # partition_on="aimtc_pseudo_nhs",
     # partition_num=10,
 )
-stop = time.time()
-stop - start
 
 # 2. Workload of interest
 
@@ -150,20 +154,209 @@ def make_query():
     )
 
 # 751 s from home, 11,051,315 rows
-start = time.time()
-raw_episodes = pd.read_sql(make_query(), con)
-stop = time.time()
-stop - start
+raw_episodes = time_fetch(pd.read_sql, make_query(), con)
 
 # 728 s from home, 11,051,315 rows
-connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
-start = time.time()
-raw_episodes = pl.read_database_uri(
+raw_episodes = time_fetch(
+    pl.read_database_uri,
     query=make_query(),
     uri=connection_uri,
     engine="connectorx",
     # partition_on="aimtc_pseudo_nhs",
     # partition_num=10,
 )
-stop = time.time()
-stop - start
\ No newline at end of file
+
+# 3. connectorx directly, returning Arrow
+
+# Calling connectorx directly with return_type="arrow" avoids
+# building Python objects for every value. The Arrow table
+# is converted to pandas with split_blocks (one block per
+# column, avoiding a consolidation copy) and self_destruct
+# (freeing each Arrow column as it is converted).
+#
+# The missing rows above are probably due to partition_on:
+# connectorx splits the range [min, max] of the partition
+# column into partition_num ranges, so the column must be
+# numeric, and rows where it is null match none of the ranges
+# and are silently dropped. aimtc_pseudo_nhs is a string
+# column containing nulls, so it is not a valid partition
+# column. Do not partition until a non-null integer key
+# is available in the view.
+def read_connectorx(query, encode_codes=False):
+    """
+    Fetch the result of the query with connectorx as an Arrow table,
+    and convert it to pandas. If encode_codes is True, dictionary
+    encode the code columns first (see dictionary_encode_codes below).
+    """
+    table = cx.read_sql(connection_uri, query, return_type="arrow")
+    if encode_codes:
+        table = dictionary_encode_codes(table)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+# Not yet timed
+raw_episodes = time_fetch(read_connectorx, make_query())
+
+# 4. Dictionary-encoding the code columns
+
+# The diagnosis and procedure columns are mostly null, and the
+# non-null values come from a small vocabulary of codes. Dictionary
+# encoding each column in Arrow before converting to pandas stores
+# each column as integer indices into the unique codes, which
+# pandas receives as a categorical. Normalising the codes (see
+# code_group_counts.normalise_codes) then only needs to be applied
+# to the categories, not to every row.
+def dictionary_encode_codes(table):
+    """
+    Dictionary-encode all the diagnosis_* and procedure_* columns
+    of an Arrow table, leaving the other columns unchanged.
+    """
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if name.startswith(("diagnosis_", "procedure_")):
+            column = pc.dictionary_encode(column)
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+# Not yet timed
+raw_episodes = time_fetch(read_connectorx, make_query(), encode_codes=True)
+
+# 5. Batched fetch from a pyodbc cursor into Arrow
+
+# Without connectorx, the rows can still be fetched in large
+# batches from the pyodbc cursor, with each batch converted to
+# an Arrow record batch column by column. This avoids building
+# one large list of rows for the whole result (as pd.read_sql
+# does), and avoids pandas consolidating blocks at the end.
+def iter_arrow_batches(con, query, batch_size=100_000):
+    """
+    Run the query using the pyodbc connection underlying the
+    SQLAlchemy engine con, and yield the result as a sequence of
+    Arrow record batches of (at most) batch_size rows.
+    """
+    connection = con.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.arraysize = batch_size
+        cursor.execute(query)
+        names = [column[0] for column in cursor.description]
+        while rows := cursor.fetchmany(batch_size):
+            arrays = [pa.array(values) for values in zip(*rows)]
+            yield pa.record_batch(arrays, names=names)
+    finally:
+        connection.close()
+
+def fetch_arrow_batches(con, query, batch_size=100_000):
+    """
+    Run the query as for iter_arrow_batches, and return the
+    whole result as an Arrow table.
+    """
+    return pa.Table.from_batches(iter_arrow_batches(con, query, batch_size))
+
+def read_arrow_batches(con, query, batch_size=100_000):
+    """
+    Fetch the query as for fetch_arrow_batches, and convert the
+    result to pandas.
+    """
+    table = fetch_arrow_batches(con, query, batch_size)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+# Not yet timed
+raw_episodes = time_fetch(read_arrow_batches, con, make_query())
+
+# 6. Long-format query filtered at the server
+
+# Most of the 48 code columns are null, and only the codes in
+# the code groups are used downstream. Instead of returning one
+# wide row per episode, the server can unpivot the code columns
+# (using cross apply over a values list) and keep only the rows
+# whose (normalised) code is in the code groups. The result is
+# a thin table with one row per relevant code.
+# The printable ASCII and whitespace characters matched by \W (i.e.
+# everything except letters, digits and underscore), which
+# normalise_code removes from the codes
+non_word_characters = string.punctuation.replace("_", "") + string.whitespace
+
+
+def normalise_code_sql(column):
+    """
+    SQL expression normalising the codes in column in the same way
+    as code_group_counts.normalise_code (lowercase, with all the
+    non-word characters removed). Each non-word character is mapped
+    to a space using translate (SQL Server 2017 or later), and then
+    the spaces are removed. Other control and non-ASCII characters
+    are not removed, but they do not appear in the codes.
+    """
+    characters = non_word_characters.replace("'", "''")
+    return (
+        f"lower(replace(translate({column}, '{characters}',"
+        f" replicate(' ', {len(non_word_characters)})), ' ', ''))"
+    )
+
+
+def make_long_query(code_list):
+    """
+    Make a query returning one row per (episode, code) for the
+    codes in code_list, which should be normalised in the same
+    way as code_group_counts.normalise_code (see normalise_code_sql).
+    The position column contains the name of the code column (e.g.
+    diagnosis_0) in the wide query.
+    """
+    # Re-use the column aliases from the wide query
+    code_columns = re.findall(r"(\w+) as ((?:diagnosis|procedure)_\d+)", make_query())
+    values = ",".join(
+        f"('{position}', episodes.{column})" for column, position in code_columns
+    )
+    codes = ",".join("'" + code.replace("'", "''") + "'" for code in set(code_list))
+    return (
+        "select episodes.aimtc_pseudo_nhs as nhs_number"
+        ",episodes.pbrspellid as spell_id"
+        ",episodes.startdate_consultantepisode as episode_start_date"
+        ",long_codes.position"
+        ",long_codes.code"
+        " from ABI.dbo.vw_apc_sem_001 as episodes"
+        f" cross apply (values {values}) as long_codes(position, code)"
+        f" where {normalise_code_sql('long_codes.code')} in ({codes})"
+    )
+
+# Not yet timed
+code_groups = get_code_groups("../codes_files/icd10.yaml", "../codes_files/opcs4.yaml")
+raw_long_codes = time_fetch(pd.read_sql, make_long_query(code_groups["name"]), con)
+
+# 7. Caching the result in a local Parquet file
+
+# Even the fastest fetch above takes minutes, and it is repeated
+# every time the script is re-run. Instead, write the batches to
+# a Parquet file as they arrive (so the whole result never needs
+# to be held in memory at once), and read the file on later runs.
+# Parquet stores the mostly-null, low-cardinality code columns
+# very compactly using dictionary encoding.
+
+def fetch_to_parquet(con, query, path, batch_size=100_000):
+    """
+    Stream the result of the query into a zstd-compressed Parquet
+    file at path. The schema is taken from the first batch.
+    """
+    writer = None
+    try:
+        for batch in iter_arrow_batches(con, query, batch_size):
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    path, batch.schema, compression="zstd", use_dictionary=True
+                )
+            writer.write_batch(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+def read_parquet_cache(path):
+    """
+    Read a file written by fetch_to_parquet into a pandas dataframe.
+    """
+    table = pq.read_table(path, memory_map=True)
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+# Not yet timed
+time_fetch(fetch_to_parquet, con, make_query(), "datasets/raw_episodes.parquet")
+
+# Not yet timed
+raw_episodes = time_fetch(read_parquet_cache, "datasets/raw_episodes.parquet")
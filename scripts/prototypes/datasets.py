@@ -7,19 +7,19 @@
 # the datasets are saved in the scripts/prototypes/datasets/, and
 # are named as follows:
 #
-# 1. manual_codes.pkl:
+# 1. manual_codes.parquet:
 #   index definition: ACS and PCI code groups from HES 
 #   outcomes: 2-point MACE (AMI and stroke) code groups from HES
 #   features: manually chosen code groups from HES
 #             age and gender from HES
 #
-# 2. all_codes.pkl:
+# 2. all_codes.pkl (sparse columns, so saved as a pickle):
 #   index definition: ACS and PCI code groups from HES 
 #   outcomes: 2-point MACE (AMI and stroke) code groups from HES
 #   features: all HES diagnosis and procedure codes as separate columns
 #             age and gender from HES
 # 
-# 3. manual_codes_swd.pkl:
+# 3. manual_codes_swd.parquet:
 #   index definition: ACS and PCI code groups from HES 
 #   outcomes: 2-point MACE (AMI and stroke) code groups from HES
 #   features: manually chosen code groups from HES
@@ -35,13 +35,28 @@
 #
 
 import os
-
-os.chdir("scripts/prototypes")
+import sys
+import pathlib
+
+# All files are found relative to this script, instead of changing the
+# working directory. When the script is run cell-by-cell in an interactive
+# window (where __file__ is not defined), the working directory is assumed
+# to be the root of the repository.
+try:
+    prototypes_dir = pathlib.Path(__file__).resolve().parent
+except NameError:
+    prototypes_dir = pathlib.Path("scripts/prototypes").resolve()
+datasets_dir = prototypes_dir / "datasets"
+codes_files_dir = prototypes_dir.parent / "codes_files"
+
+# Make the helper modules below importable from any working directory
+sys.path.insert(0, str(prototypes_dir))
 
 import importlib
 import datetime as dt
 
 import pandas as pd
+import polars as pl
 
 from py_hbr.clinical_codes import get_codes_in_group, ClinicalCodeParser
 
@@ -50,11 +65,15 @@ import swd
 import mortality as mort
 import save_datasets as ds
 
-importlib.reload(swd)
-importlib.reload(hes)
-importlib.reload(mort)
-# importlib.reload(codes)
-importlib.reload(ds)
+# Reloading is only useful when editing the modules in an interactive
+# session. Set DEV_RELOAD=1 to enable it; otherwise each module is only
+# imported once.
+if os.environ.get("DEV_RELOAD"):
+    importlib.reload(swd)
+    importlib.reload(hes)
+    importlib.reload(mort)
+    # importlib.reload(codes)
+    importlib.reload(ds)
 
 import numpy as np
 
@@ -100,16 +119,29 @@ attribute_valid_window = dt.timedelta(days=41)
 # Dataset containing one row per episode, grouped into spells by
 # spell_id, with some patient demographic information (age and gender)
 # and (predominantly) diagnosis and procedure columns
-raw_episodes_data = hes.get_raw_episodes_data(start_date, end_date, from_file)
+raw_episodes_data = hes.get_raw_episodes_data(
+    start_date, end_date, from_file, datasets_dir
+)
+
+# The spell_id is a string key, used to group episodes into spells.
+# Storing it as a categorical means the grouping (and any merge with
+# the same categories) uses integer codes instead of hashing strings.
+# The other keys (patient_id, episode_id and attribute_id) are already
+# narrow integers.
+raw_episodes_data["spell_id"] = raw_episodes_data["spell_id"].astype("category")
 
 # Get all the clinical codes in long format, with a column to indicate
 # whether it is a diagnosis or a procedure code. Note that this is
 # currently returning slightly less rows than raw_episode_data,
 # maybe if some rows contain no codes at all? More likely a bug -- to check.
+# The code columns are categoricals (the code groups are given the same
+# categories in make_code_group_counts).
 long_clinical_codes = hes.convert_codes_to_long(raw_episodes_data, "episode_id")
 
 # Convert the diagnosis and procedure columns into
-code_group_counts = hes.make_code_group_counts(long_clinical_codes, raw_episodes_data)
+code_group_counts = hes.make_code_group_counts(
+    long_clinical_codes, raw_episodes_data, codes_files_dir
+)
 
 # Get the latest (right censor) and earliest (left censor) dates seen
 # in the data set
@@ -119,13 +151,26 @@ raw_mortality_data = mort.get_mortality_data(start_date, end_date)
 # From the guidance document: "a small number of duplicates are present in the dataset - "
 # "this is the case for around 55 entries. The cause for these is unknown and is under "
 # "investigation".
-raw_mortality_data = raw_mortality_data.groupby("patient_id").filter(
-    lambda x: len(x) == 1
+# Drop all rows for patients that appear more than once (keep=False marks
+# every duplicate, not just the second and later ones)
+raw_mortality_data = raw_mortality_data[
+    ~raw_mortality_data["patient_id"].duplicated(keep=False)
+]
+
+# Replace empty strings with NaN. Only the string columns can contain
+# "", so the numeric and date columns are not scanned
+string_cols = raw_mortality_data.select_dtypes(include=["object", "string"]).columns
+raw_mortality_data[string_cols] = raw_mortality_data[string_cols].mask(
+    raw_mortality_data[string_cols].eq("")
 )
 
-raw_mortality_data.replace("", np.nan, inplace=True)
-# Not sure why this is necessary, it doesn't seem necessary with the episodes
-raw_mortality_data["patient_id"] = raw_mortality_data["patient_id"].astype(np.int64)
+# The patient_id is the join key between the episodes, mortality and
+# attributes tables. It is fetched as a string in the mortality data, so
+# convert it to an integer (the same as the episodes), using the narrowest
+# integer type that fits. Note that NHS numbers have 10 digits, so this
+# will usually still be int64.
+for df in (raw_episodes_data, raw_mortality_data):
+    df["patient_id"] = pd.to_numeric(df["patient_id"], downcast="integer")
 
 # To find out whether a patient has died in the follow-up period
 mortality_dates = raw_mortality_data[["patient_id", "date_of_death"]]
@@ -137,10 +182,12 @@ long_mortality = mort.convert_codes_to_long(raw_mortality_data)
 
 # Drop duplicate ICD-10 cause of death values by retaining only
 # the highest priority value (the one with the lowest position).
-# This information is used to find the cause of death if necessary
-long_mortality = long_mortality.loc[
-    long_mortality.groupby(["patient_id", "cause_of_death"])["position"].idxmin()
-].reset_index(drop=True)
+# This information is used to find the cause of death if necessary.
+# Any later use is a key-based merge on patient_id, so the index is
+# not reset after dropping rows.
+long_mortality = long_mortality.sort_values("position", kind="stable").drop_duplicates(
+    ["patient_id", "cause_of_death"], keep="first"
+)
 
 # Find the index episodes, which are the ones that contain an ACS or PCI and
 # are also the first episode of the spell.
@@ -166,6 +213,25 @@ episodes_before = hes.get_episodes_before_index(
     time_to_episode, min_period_before, max_period_before
 )
 
+# This table contains the total number of each diagnosis and procedure
+# group in a period after the index event. A fixed window immediately
+# after the index event is excluded, to filter out peri-procedural
+# outcomes or outcomes that occur in the index event itself. A follow-up
+# date is defined that becomes the "outcome_occurred" column in the
+# dataset, for classification models.
+episodes_after = hes.get_episodes_after_index(
+    time_to_episode, min_period_after, follow_up
+)
+
+# Compute the outcome columns based on the following code groups
+outcome_groups = [
+    "bleeding_al_ani",
+    "bleeding_cadth",
+    "bleeding_adaptt",
+    "acs_bezin",
+    "hussain_ami_stroke",
+]
+
 # Get a table of how many of each code group occurred before each index event
 feature_counts = hes.get_code_groups_before_index(
     episodes_before, code_group_counts, idx_episodes
@@ -178,60 +244,51 @@ feature_any_code = hes.get_all_codes_before_index(
     episodes_before, long_clinical_codes, idx_episodes
 )
 
+# Outcome columns based on the code groups above
+outcome_counts = hes.make_outcomes(
+    outcome_groups, idx_episodes, episodes_after, code_group_counts
+)
+
+# Outcome column all_cause_death_outcome
+all_cause_death = mort.get_all_cause_death(idx_episodes, mortality_dates, follow_up)
+
 # Plot the distribution of codes over the index episodes. The envelope on the
 # right follows from assigning column indices in order of code-first-seen, which
 # naturally biases in favour of more common codes.
-# import seaborn as sns
+# The image is drawn with imshow directly from a uint8 array of the first
+# 1000 index episodes (taken from the sparse columns without densifying the
+# rest), instead of a seaborn heatmap, which is very slow for thousands of
+# columns that cannot be resolved on screen anyway.
 # import matplotlib.pyplot as plt
 
-# s = sns.heatmap(any_code_before)
-# s = s.set(
+# any_code_before = (
+#     feature_any_code.drop(columns="idx_episode_id")
+#     .sparse.to_coo()
+#     .tocsr()[:1000]
+#     .toarray()
+# )
+# fig, ax = plt.subplots()
+# ax.imshow(any_code_before, aspect="auto", interpolation="nearest", cmap="Greys")
+# ax.set(
 #     xlabel="Diagnosis/Procedure Codes",
 #     ylabel="Index Episode ID",
 #     title="Distribution of Diagnosis/Procedure Codes",
 # )
 # plt.show()
 
-# This table contains the total number of each diagnosis and procedure
-# group in a period after the index event. A fixed window immediately
-# after the index event is excluded, to filter out peri-procedural
-# outcomes or outcomes that occur in the index event itself. A follow-up
-# date is defined that becomes the "outcome_occurred" column in the
-# dataset, for classification models.
-
-
-# Outcome column all_cause_death_outcome
-all_cause_death = mort.get_all_cause_death(idx_episodes, mortality_dates, follow_up)
-
-episodes_after = hes.get_episodes_after_index(
-    time_to_episode, min_period_after, follow_up
-)
-
-# Compute the outcome columns based on the following code groups
-outcome_groups = [
-    "bleeding_al_ani",
-    "bleeding_cadth",
-    "bleeding_adaptt",
-    "acs_bezin",
-    "hussain_ami_stroke",
-]
-outcome_counts = hes.make_outcomes(
-    outcome_groups, idx_episodes, episodes_after, code_group_counts
-)
-
 # Make the dataset whose feature columns are code groups defined in the
 # icd10.yaml and opcs4.yaml file, and whose outcome columns are defined
 # in the list above, along with all-cause mortality.
 manual_codes = hes.make_dataset_from_features(
     idx_episodes, feature_counts, outcome_counts, all_cause_death
 )
-ds.save_dataset(manual_codes, "manual_codes")
+ds.save_dataset(manual_codes, "manual_codes", datasets_dir)
 
 # Make the sparse all-code features dataset
 all_codes = hes.make_dataset_from_features(
     idx_episodes, feature_any_code, outcome_counts, all_cause_death
 )
-ds.save_dataset(all_codes, "all_codes")
+ds.save_dataset(all_codes, "all_codes", datasets_dir)
 
 # Now link the system-wide dataset attributes. An index event is included
 # if it has a row of attributes in the SWD up to a month before the heart
@@ -240,12 +297,24 @@ ds.save_dataset(all_codes, "all_codes")
 # Load raw attributes data
 patient_ids = idx_episodes["patient_id"].unique()
 raw_attributes = swd.get_raw_attributes_data(
-    start_date, end_date, patient_ids, from_file
+    start_date, end_date, patient_ids, from_file, datasets_dir
 )
 
-# Remove index events where the patient is not in the attributes
-swd_idx_episodes = idx_episodes[
-    idx_episodes["patient_id"].isin(raw_attributes["patient_id"])
+# The attributes query only fetches patients in patient_ids, but not every
+# patient with an index event has attributes. Those index events get no
+# attribute row in the as-of join below, and are removed by the filter
+# after it, so there is no need to remove them with a separate isin first.
+#
+# The join keys must have the same types on both sides of the as-of join
+# below (polars does not cast between datetime units or integer widths).
+# Make sure the dates are datetimes (not objects holding dates), then cast
+# both sides to microsecond datetimes and 64-bit patient ids.
+swd_idx_episodes = idx_episodes.assign(
+    idx_date=pd.to_datetime(idx_episodes["idx_date"])
+)
+join_key_types = [
+    pl.col("patient_id").cast(pl.Int64),
+    pl.col("^(idx_date|attribute_period)$").cast(pl.Datetime("us")),
 ]
 
 # Join the attributes onto the index episodes by patient, and then
@@ -266,47 +335,99 @@ swd_idx_episodes = idx_episodes[
 # Ensure that attribute_valid_window is slightly larger than a multiple
 # of months to ensure that a full month is captured.
 #
+# Instead of joining every attribute row for a patient onto each of
+# their index episodes (and then discarding almost all of them), an
+# as-of join picks, for each index episode, the most recent attribute
+# row whose month ends before the index date (i.e. the attribute_period
+# + 31 days is before idx_date), within the attribute_valid_window.
+# This keeps the preferred (most recent) attributes when the window
+# covers more than one month. The filter afterwards enforces the
+# strict inequalities above (the as-of join also allows equality) and
+# removes index episodes with no attributes in the window. The whole
+# thing is a polars lazy query, collected once and converted back to
+# pandas.
 df = (
-    swd_idx_episodes.merge(
-        raw_attributes[["patient_id", "attribute_period", "attribute_id"]],
-        how="left",
-        on="patient_id",
+    pl.from_pandas(swd_idx_episodes)
+    .lazy()
+    .with_columns(join_key_types)
+    .sort("idx_date")
+    .join_asof(
+        pl.from_pandas(
+            raw_attributes[["patient_id", "attribute_period", "attribute_id"]]
+        )
+        .lazy()
+        .with_columns(join_key_types)
+        .with_columns(
+            attribute_end=pl.col("attribute_period") + dt.timedelta(days=31)
+        )
+        .sort("attribute_end"),
+        left_on="idx_date",
+        right_on="attribute_end",
+        by="patient_id",
+        strategy="backward",
+        tolerance=attribute_valid_window - dt.timedelta(days=31),
     )
-    .groupby("idx_episode_id")
-    .apply(
-        lambda g: g[
-            ((g["attribute_period"] + dt.timedelta(days=31)) < g["idx_date"])
-            & ((g["idx_date"] - g["attribute_period"]) < attribute_valid_window)
-        ]
+    .filter(
+        (pl.col("attribute_end") < pl.col("idx_date"))
+        & ((pl.col("idx_date") - pl.col("attribute_period")) < attribute_valid_window)
     )
-    .reset_index(drop=True)
-    .drop(columns=["attribute_period"])
+    .drop(["attribute_period", "attribute_end"])
+    .collect()
+    .to_pandas()
 )
 
-# Prepare the other attributes for joining as features
-feature_attributes = raw_attributes.drop(columns=["patient_id", "attribute_period"])
+# Prepare the other attributes for joining as features. The attribute_id
+# is the row number in raw_attributes, so the attributes chosen by the
+# as-of join above are taken by position (one row per index episode in
+# df), instead of copying the whole wide attributes table and merging it
+# on attribute_id.
+feature_attributes = (
+    raw_attributes.take(df["attribute_id"].to_numpy())
+    .drop(columns=["patient_id", "attribute_period", "attribute_id"])
+    .set_axis(df.index)
+)
 
-# Now join on all the attributes by attribute_id, and the standard HES feature code
-# groups and outcome columns
+# The standard HES feature code groups and outcome columns all have one
+# row per index episode, in the order of idx_episodes, and disjoint
+# columns. They are placed side by side with a column-wise concat (which
+# does not need to hash the keys when the indexes are identical), instead
+# of merging each one onto the wide attributes table
+idx_features = pd.concat(
+    [
+        table.set_index("idx_episode_id")
+        for table in (feature_counts, outcome_counts, all_cause_death)
+    ],
+    axis=1,
+).reindex(idx_episodes["idx_episode_id"])
+
+# Now put the attributes next to the index episodes they were chosen for,
+# and join the standard HES feature code groups and outcome columns. The id
+# columns that are not needed in the dataset are dropped first, so that they
+# are not carried through the join.
 manual_codes_swd = (
-    df.merge(feature_attributes, how="left", on="attribute_id")
-    .merge(feature_counts, how="left", on="idx_episode_id")
-    .merge(outcome_counts, how="left", on="idx_episode_id")
-    .merge(all_cause_death, how="left", on="idx_episode_id")
+    pd.concat(
+        [
+            df.drop(columns=["idx_spell_id", "patient_id", "attribute_id"]),
+            feature_attributes,
+        ],
+        axis=1,
+    )
+    .join(idx_features, how="left", on="idx_episode_id")
     .set_index("idx_episode_id")
-    .drop(columns=["idx_spell_id", "patient_id", "attribute_id"])
 )
 
 # Check that the primary care attributes age agrees with the HES age
 # thoughout the dataset, then remove the SWD age columns. Allow a discrepancy
 # of up to 1 year due to rounding. There are places where the age is out by
 # one year, but in this version of the script this discrepancy is ignored.
-age_not_equal = abs(manual_codes_swd["dem_age"] - manual_codes_swd["swd_age"] > 1)
+# The difference is computed on the numpy arrays (the rows are aligned
+# already, so there is no need for pandas index alignment).
+age_diff = manual_codes_swd["dem_age"].to_numpy() - manual_codes_swd["swd_age"].to_numpy()
+age_not_equal = np.abs(age_diff) > 1
 num_age_not_equal = age_not_equal.sum()
 print(f"Removing {num_age_not_equal} rows where HES age and primary care attributes disagree by more than 1 year")
-manual_codes_swd = manual_codes_swd[~age_not_equal]
-manual_codes_swd.drop(columns=["swd_age"], inplace=True)
+manual_codes_swd = manual_codes_swd.loc[~age_not_equal].drop(columns="swd_age")
 
 # Also drop the gender/sex duplicate column -- might help models
 
-ds.save_dataset(manual_codes_swd, "manual_codes_swd")
\ No newline at end of file
+ds.save_dataset(manual_codes_swd, "manual_codes_swd", datasets_dir)
\ No newline at end of file
@@ -1,16 +1,53 @@
 import os
-os.chdir("scripts/prototypes")
+import sys
+import pathlib
+
+# Find the datasets relative to this script, instead of changing the
+# working directory (see datasets.py)
+try:
+    prototypes_dir = pathlib.Path(__file__).resolve().parent
+except NameError:
+    prototypes_dir = pathlib.Path("scripts/prototypes").resolve()
+datasets_dir = prototypes_dir / "datasets"
+sys.path.insert(0, str(prototypes_dir))
 
 import save_datasets as ds
 
 import importlib
-importlib.reload(ds)
+if os.environ.get("DEV_RELOAD"):
+    importlib.reload(ds)
 
 import matplotlib.pyplot as plt
 import seaborn as sns
 sns.set_theme()
 
-df = ds.load_dataset("manual_codes", False)
+
+def correlation(df):
+    """
+    Pearson correlation between the numeric (and boolean) columns of df,
+    using pairwise-complete observations (so a missing value in one
+    column does not affect the correlations of the other columns).
+    """
+    return df.select_dtypes(include=["number", "bool"]).corr()
+
+
+# Only the index, demographic and outcome columns are used below, so
+# only read those from the dataset file (not the code group counts)
+columns = [
+    "dem_age",
+    "dem_gender",
+    "idx_date",
+    "idx_pci_performed",
+    "idx_stemi",
+    "idx_nstemi",
+    "bleeding_al_ani_outcome",
+    "bleeding_cadth_outcome",
+    "bleeding_adaptt_outcome",
+    "acs_bezin_outcome",
+    "hussain_ami_stroke_outcome",
+    "all_cause_death_outcome",
+]
+df = ds.load_dataset("manual_codes", False, columns, datasets_dir)
 
 df["mace"] = df["hussain_ami_stroke_outcome"] | df["all_cause_death_outcome"]
 
@@ -37,9 +74,9 @@ plt.show()
 pyplot.hist(y, bins, alpha=0.5, label='NSTEMI')
 
 # Plot of the correlations between outcome columns
-outcomes = df.filter()
+outcomes = df.filter(regex="_outcome")
 outcomes.columns = outcomes.columns.str.replace("_outcome", "")
-corr = df.corr()
+corr = correlation(outcomes)
 
 plt.matshow(corr)
 plt.show()
@@ -47,15 +84,17 @@ plt.show()
 # Show correlations between index features (i.e. not prior code counts)
 idx_features = df.filter(regex="(dem|idx)")
 idx_features.columns = idx_features.columns.str.replace("(idx_|dem_)", "", regex=True)
-corr = idx_features.corr()
+corr = correlation(idx_features)
 sns.heatmap(corr,xticklabels=True, yticklabels=True)
 plt.tight_layout()
 plt.show()
 
-# Show correlations between index features (i.e. not prior code counts)
-idx_features = df.filter(regex="(dem|idx)")
+# Show correlations between index features and outcomes (only these
+# columns are correlated, not every code group count, because the
+# cost grows with the square of the number of columns)
+idx_features = df.filter(regex="(dem|idx|outcome)")
 idx_features.columns = idx_features.columns.str.replace("(idx_|dem_)", "", regex=True)
-corr = df.corr()
+corr = correlation(idx_features)
 sns.heatmap(corr,xticklabels=True, yticklabels=True)
 plt.tight_layout()
 plt.show()
\ No newline at end of file
@@ -1,8 +1,40 @@
 import save_datasets as ds
 import numpy as np
+import joblib
+import hashlib
+import inspect
 from sklearn.model_selection import train_test_split
 from stability import fit_model, predict_bootstrapped_proba
 
+# Cache of the fitted models, keyed by the source code of the module
+# defining the model class, the model class, the training data and the
+# other arguments of fit_model. Caching is opt-in (set "use_fit_cache" to
+# True in model_data), because a cached result also reuses the same
+# bootstrap resamples instead of drawing new ones. Editing the module
+# containing the model class (e.g. models.py) invalidates its cached fits;
+# delete the .cache/fit folder to clear everything else (e.g. after
+# changing stability.py or a module imported by models.py).
+fit_cache = joblib.Memory(location=".cache/fit", verbose=0)
+
+
+@fit_cache.cache
+def _fit_model_for_source(model_source_hash, *args, **kwargs):
+    """
+    Call fit_model. The model_source_hash argument is not used, but it
+    is part of the cache key (see fit_model_cached).
+    """
+    return fit_model(*args, **kwargs)
+
+
+def fit_model_cached(Model, *args, **kwargs):
+    """
+    Like fit_model, but reuse the result of a previous call with the same
+    arguments, as long as the module containing Model has not changed.
+    """
+    source = inspect.getsource(inspect.getmodule(Model))
+    model_source_hash = hashlib.sha256(source.encode()).hexdigest()
+    return _fit_model_for_source(model_source_hash, Model, *args, **kwargs)
+
 
 def fit_and_save(model_data):
     """
@@ -24,8 +56,12 @@ def fit_and_save(model_data):
     # preprocessing step.
     object_column_indices = dataset.object_column_indices
 
-    # Get the feature matrix X and outcome vector y
+    # Get the feature matrix X and outcome vector y. If there are no object
+    # columns, store X as float32: this halves its memory, and the tree-based
+    # models convert X to float32 anyway (so a float64 X would be copied).
     X = dataset.get_X()
+    if len(object_column_indices) == 0:
+        X = X.astype(np.float32, copy=False)
 
     # outcome = hussain_ami_stroke_outcome
     y = dataset.get_y(model_data["outcome"])
@@ -49,7 +85,13 @@ def fit_and_save(model_data):
 
     # Fit the model-under-test M0 to the training set (X0_train, y0_train), and
     # fit M other models to M other bootstrap resamples of (X0_train, y0_train).
-    M0, Mm = fit_model(Model, object_column_indices, X0_train, y0_train, M=10)
+    # Previously fitted models are only reused if model_data["use_fit_cache"]
+    # is True (see fit_cache).
+    if model_data.get("use_fit_cache", False):
+        fit = fit_model_cached
+    else:
+        fit = fit_model
+    M0, Mm = fit(Model, object_column_indices, X0_train, y0_train, M=10)
 
     # First columns is the probability of 1 in y_test from M0; other columns
     # are the same for the N bootstrapped models Mm.
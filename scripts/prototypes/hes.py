@@ -1,11 +1,95 @@
 import sqlalchemy as sql
+import os
 import pandas as pd
 import polars as pl
 import time
-import re
 import code_group_counts as codes
 import numpy as np
+import scipy.sparse
 import sparse_encode as spe
+import raw_load
+
+# The diagnosis (ICD-10) and procedure (OPCS-4) columns in the HES views,
+# in order of position (the primary code first, then the secondaries)
+diagnosis_columns = [
+    "diagnosisprimary_icd",
+    "diagnosis1stsecondary_icd",
+    "diagnosis2ndsecondary_icd",
+    "diagnosis3rdsecondary_icd",
+    "diagnosis4thsecondary_icd",
+    "diagnosis5thsecondary_icd",
+    "diagnosis6thsecondary_icd",
+    "diagnosis7thsecondary_icd",
+    "diagnosis8thsecondary_icd",
+    "diagnosis9thsecondary_icd",
+    "diagnosis10thsecondary_icd",
+    "diagnosis11thsecondary_icd",
+    "diagnosis12thsecondary_icd",
+    "diagnosis13thsecondary_icd",
+    "diagnosis14thsecondary_icd",
+    "diagnosis15thsecondary_icd",
+    "diagnosis16thsecondary_icd",
+    "diagnosis17thsecondary_icd",
+    "diagnosis18thsecondary_icd",
+    "diagnosis19thsecondary_icd",
+    "diagnosis20thsecondary_icd",
+    "diagnosis21stsecondary_icd",
+    "diagnosis22ndsecondary_icd",
+    "diagnosis23rdsecondary_icd",
+]
+
+procedure_columns = [
+    "primaryprocedure_opcs",
+    "procedure2nd_opcs",
+    "procedure3rd_opcs",
+    "procedure4th_opcs",
+    "procedure5th_opcs",
+    "procedure6th_opcs",
+    "procedure7th_opcs",
+    "procedure8th_opcs",
+    "procedure9th_opcs",
+    "procedure10th_opcs",
+    "procedure11th_opcs",
+    "procedure12th_opcs",
+    "procedure13th_opcs",
+    "procedure14th_opcs",
+    "procedure15th_opcs",
+    "procedure16th_opcs",
+    "procedure17th_opcs",
+    "procedure18th_opcs",
+    "procedure19th_opcs",
+    "procedure20th_opcs",
+    "procedure21st_opcs",
+    "procedure22nd_opcs",
+    "procedure23rd_opcs",
+    "procedure24th_opcs",
+]
+
+
+def code_columns():
+    """
+    Get the list of (column, clinical_code_type, position) for all
+    the diagnosis and procedure columns in the HES views.
+    """
+    return [
+        (column, "diagnosis", position)
+        for position, column in enumerate(diagnosis_columns)
+    ] + [
+        (column, "procedure", position)
+        for position, column in enumerate(procedure_columns)
+    ]
+
+
+# The names of the diagnosis and procedure columns returned by the spells
+# and episodes queries (e.g. diagnosis_0 or procedure_12), mapped to the
+# code type and position of each column
+code_column_types = {
+    f"{code_type}_{position}": code_type for _, code_type, position in code_columns()
+}
+code_column_positions = {
+    f"{code_type}_{position}": position for _, code_type, position in code_columns()
+}
+
 
 def diagnosis_and_procedure_columns():
     """
@@ -13,55 +97,27 @@ def diagnosis_and_procedure_columns():
     query, which is common to both the episodes and
     spells queries.
     """
+    return "".join(
+        f",{column} as {code_type}_{position}"
+        for column, code_type, position in code_columns()
+    )
+
+
+def codes_cross_apply():
+    """
+    Get a cross apply clause which unpivots the diagnosis and
+    procedure columns in the server, producing one row per code
+    with columns clinical_code_type, position and clinical_code
+    (the unnormalised code). Rows where the code is missing must
+    still be removed in the where clause.
+    """
+    values = ",".join(
+        f"('{code_type}',{position},{column})"
+        for column, code_type, position in code_columns()
+    )
     return (
-        ",diagnosisprimary_icd as diagnosis_0"
-        ",diagnosis1stsecondary_icd as diagnosis_1"
-        ",diagnosis2ndsecondary_icd as diagnosis_2"
-        ",diagnosis3rdsecondary_icd as diagnosis_3"
-        ",diagnosis4thsecondary_icd as diagnosis_4"
-        ",diagnosis5thsecondary_icd as diagnosis_5"
-        ",diagnosis6thsecondary_icd as diagnosis_6"
-        ",diagnosis7thsecondary_icd as diagnosis_7"
-        ",diagnosis8thsecondary_icd as diagnosis_8"
-        ",diagnosis9thsecondary_icd as diagnosis_9"
-        ",diagnosis10thsecondary_icd as diagnosis_10"
-        ",diagnosis11thsecondary_icd as diagnosis_11"
-        ",diagnosis12thsecondary_icd as diagnosis_12"
-        ",diagnosis13thsecondary_icd as diagnosis_13"
-        ",diagnosis14thsecondary_icd as diagnosis_14"
-        ",diagnosis15thsecondary_icd as diagnosis_15"
-        ",diagnosis16thsecondary_icd as diagnosis_16"
-        ",diagnosis17thsecondary_icd as diagnosis_17"
-        ",diagnosis18thsecondary_icd as diagnosis_18"
-        ",diagnosis19thsecondary_icd as diagnosis_19"
-        ",diagnosis20thsecondary_icd as diagnosis_20"
-        ",diagnosis21stsecondary_icd as diagnosis_21"
-        ",diagnosis22ndsecondary_icd as diagnosis_22"
-        ",diagnosis23rdsecondary_icd as diagnosis_23"
-        ",primaryprocedure_opcs as procedure_0"
-        ",procedure2nd_opcs as procedure_1"
-        ",procedure3rd_opcs as procedure_2"
-        ",procedure4th_opcs as procedure_3"
-        ",procedure5th_opcs as procedure_4"
-        ",procedure6th_opcs as procedure_5"
-        ",procedure7th_opcs as procedure_6"
-        ",procedure8th_opcs as procedure_7"
-        ",procedure9th_opcs as procedure_8"
-        ",procedure10th_opcs as procedure_9"
-        ",procedure11th_opcs as procedure_10"
-        ",procedure12th_opcs as procedure_11"
-        ",procedure13th_opcs as procedure_12"
-        ",procedure14th_opcs as procedure_13"
-        ",procedure15th_opcs as procedure_14"
-        ",procedure16th_opcs as procedure_15"
-        ",procedure17th_opcs as procedure_16"
-        ",procedure18th_opcs as procedure_17"
-        ",procedure19th_opcs as procedure_18"
-        ",procedure20th_opcs as procedure_19"
-        ",procedure21st_opcs as procedure_20"
-        ",procedure22nd_opcs as procedure_21"
-        ",procedure23rd_opcs as procedure_22"
-        ",procedure24th_opcs as procedure_23"
+        f" cross apply (values {values})"
+        " as codes(clinical_code_type, position, clinical_code)"
     )
 
 
@@ -95,6 +151,20 @@ def make_episodes_query(start_date, end_date):
     )
 
 
+def spells_where_clause(start_date, end_date):
+    """
+    Get the where clause of the spells queries, which selects the
+    valid spells starting between start_date and end_date.
+    """
+    return (
+        f" where aimtc_providerspell_start_date between '{start_date}' and '{end_date}'"
+        " and aimtc_pseudo_nhs is not null"
+        # See comments above for exclusions
+        " and aimtc_pseudo_nhs != '9000219621'"
+        " and aimtc_organisationcode_codeofcommissioner in ('5M8','11T','5QJ','11H','5A3','12A','15C','14F','Q65')"
+    )
+
+
 def make_spells_query(start_date, end_date):
     return (
         "select aimtc_pseudo_nhs as patient_id"
@@ -105,14 +175,51 @@ def make_spells_query(start_date, end_date):
         ",aimtc_providerspell_end_date as spell_end_date"
         + diagnosis_and_procedure_columns()
         + " from abi.dbo.vw_apc_sem_spell_001"
-        f" where aimtc_providerspell_start_date between '{start_date}' and '{end_date}'"
-        " and aimtc_pseudo_nhs is not null"
-        # See comments above for exclusions
-        " and aimtc_pseudo_nhs != '9000219621'"
-        " and aimtc_organisationcode_codeofcommissioner in ('5M8','11T','5QJ','11H','5A3','12A','15C','14F','Q65')"
+        + spells_where_clause(start_date, end_date)
     )
 
 
+def make_spell_codes_query(start_date, end_date, cross_apply=True):
+    """
+    Like make_spells_query, but only fetch the diagnosis and procedure
+    codes of each spell, already in long format (one row per spell_id and
+    code). The unpivot is done in the server (see codes_cross_apply), so
+    that the missing codes (most of the code columns) are never fetched.
+
+    If cross_apply is False, the query is written instead as a union all
+    of one select per code column, which gives the same result without
+    using cross apply (in case it is not allowed or slow).
+    """
+    if cross_apply:
+        return (
+            "select pbrspellid as spell_id"
+            ",codes.clinical_code_type"
+            ",codes.position"
+            ",codes.clinical_code"
+            " from abi.dbo.vw_apc_sem_spell_001"
+            + codes_cross_apply()
+            + spells_where_clause(start_date, end_date)
+            + " and codes.clinical_code is not null"
+            " and codes.clinical_code != ''"
+        )
+    return " union all ".join(
+        "select pbrspellid as spell_id"
+        f",'{code_type}' as clinical_code_type"
+        f",{position} as position"
+        f",{column} as clinical_code"
+        " from abi.dbo.vw_apc_sem_spell_001"
+        + spells_where_clause(start_date, end_date)
+        + f" and {column} is not null"
+        f" and {column} != ''"
+        for column, code_type, position in code_columns()
+    )
+
+
+# Connection string for fetching data with connectorx (and polars), which
+# does not use the xsw ODBC data source
+connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
+
+
 def get_hes_data(start_date, end_date, spells_or_episodes):
     if spells_or_episodes not in ["spells", "episodes"]:
         raise ValueError(
@@ -121,18 +228,51 @@ def get_hes_data(start_date, end_date, spells_or_episodes):
     con = sql.create_engine("mssql+pyodbc://xsw")
     start = time.time()
     if spells_or_episodes == "episodes":
-        raw_data = pd.read_sql(make_episodes_query(start_date, end_date), con)
+        query = make_episodes_query(start_date, end_date)
     else:
-        raw_data = pd.read_sql(make_spells_query(start_date, end_date), con)
+        query = make_spells_query(start_date, end_date)
+    raw_data = raw_load.read_sql(query, con, connection_uri)
     stop = time.time()
     print(f"Time to fetch spells data: {stop - start}")
     return raw_data
 
 
-def get_spells_hes_polars():
-    connection_uri = "mssql://XSW-000-SP09/ABI?trusted_connection=true"
+def get_spell_codes_data(start_date, end_date, cross_apply=True):
+    """
+    Fetch the diagnosis and procedure codes of the spells between
+    start_date and end_date in long format, with the same columns as
+    convert_codes_to_long(df, "spell_id") (the clinical codes are
+    normalised in the same way). This avoids fetching the wide code
+    columns and unpivoting them locally. See make_spell_codes_query
+    for the cross_apply argument.
+    """
+    con = sql.create_engine("mssql+pyodbc://xsw")
     start = time.time()
-    raw_data = pl.read_database(query=query, connection=connection_uri)
+    long_codes = raw_load.read_sql(
+        make_spell_codes_query(start_date, end_date, cross_apply), con, connection_uri
+    )
+    stop = time.time()
+    print(f"Time to fetch spell codes data: {stop - start}")
+    long_codes["clinical_code_type"] = long_codes["clinical_code_type"].astype(
+        pd.CategoricalDtype(["diagnosis", "procedure"])
+    )
+    long_codes["clinical_code"] = codes.normalise_codes(
+        long_codes["clinical_code"]
+    ).astype("category")
+    long_codes["position"] = long_codes["position"].astype(np.int8)
+    return long_codes[["spell_id", "clinical_code_type", "clinical_code", "position"]]
+
+
+def get_spells_hes_polars(start_date, end_date):
+    """
+    Like get_hes_data(start_date, end_date, "spells"), but fetch the
+    spells directly into a polars dataframe (using connectorx, which
+    fetches the result into Arrow columns without going through pandas).
+    """
+    start = time.time()
+    raw_data = pl.read_database_uri(
+        make_spells_query(start_date, end_date), connection_uri, engine="connectorx"
+    )
     stop = time.time()
     print(f"Time to fetch spells data: {stop - start}")
     return raw_data
@@ -149,50 +289,68 @@ def convert_codes_to_long(df, record_id):
     The record_id is either "spell_id" or "episode_id", depending on whether
     the table contains spells or episodes.
 
+    df can be a pandas dataframe, or a polars DataFrame or LazyFrame (e.g.
+    from get_spells_hes_polars()). A LazyFrame is not collected before the
+    unpivot, so the fetch and the conversion run as one query.
+
     Testing: not yet tested
     """
-    pattern = re.compile("(diagnosis|procedure)")
-    code_cols = [s for s in df.columns if pattern.search(s)]
-
-    # Pivot all the diagnosis and procedure codes into one
-    # columns. Consider https://stackoverflow.com/questions/47684961/
-    # melt-uneven-data-in-columns-and-ignore-nans-using-pandas
-    # for speed.
+    if isinstance(df, pd.DataFrame):
+        columns = df.columns
+    else:
+        df = df.lazy()
+        columns = df.collect_schema().names()
+    code_cols = [col for col in columns if col in code_column_types]
 
     if record_id not in ["episode_id", "spell_id"]:
         raise ValueError(
             f"Unrecognised record_id {record_id}; should be 'spell_id' or 'episode_id'"
         )
 
-    # Lower-memory pivoting by chunking from "https://stackoverflow.com/questions/
-    # "55860924/pandas-pd-melt-throwing-memory-error-on-unpivoting-3-5-gb-csv-while"
-    # "-using-500gb"
-    # Equivalent single line commented out below
-    #long_codes = pd.melt(df, id_vars=[record_id], value_vars=code_cols).dropna()
+    # Pivot all the diagnosis and procedure codes into one column using
+    # polars (the pandas melt of the full table used too much memory, and
+    # had to be done in chunks). The whole conversion is one lazy query,
+    # so the missing codes are dropped as the table is unpivoted, and the
+    # string processing runs in parallel. The codes are normalised in the
+    # same way as code_group_counts.normalise_code (remove non-word
+    # characters and convert to lower case). The code type and position
+    # of each code column are looked up from the column name (instead of
+    # parsing the name of the column in every row).
     #
-    # The fact that this is working maybe means I should be considering 
-    # dask or something.
-    pivot_list = list()
-    chunk_size = 10000
-    for i in range(0,len(df),chunk_size):
-        row_pivot =df.iloc[i:i+chunk_size].melt(id_vars=[record_id],value_vars=code_cols).dropna()
-        pivot_list.append(row_pivot)
-    long_codes = pd.concat(pivot_list)
-
-    long_codes.value = long_codes.value.apply(codes.normalise_code)
-    # Prepend icd10 or opc4 to the codes to indicate which are which
-    # (because some codes appear in both ICD-10 and OPCS-4)
-    pattern = re.compile("diagnosis")
-    long_codes["clinical_code_type"] = [
-        "diagnosis" if pattern.search(s) else "procedure" for s in long_codes.variable
-    ]
-    long_codes["clinical_code"] = long_codes.value
-    long_codes["position"] = (
-        long_codes["variable"]
-        .replace("(diagnosis|procedure)_", "", regex=True)
-        .astype(int)
+    # The code type and code columns are returned as pandas categoricals.
+    # There are only two code types and a few thousand distinct codes, so
+    # this is much smaller than columns of strings, and merges/groupbys on
+    # the codes use the integer category codes.
+    #
+    # Empty strings are dropped along with the nulls, because polars
+    # inputs have not been through the replace("", NaN) of the pandas
+    # loaders.
+    if isinstance(df, pd.DataFrame):
+        df = pl.from_pandas(df[[record_id, *code_cols]]).lazy()
+    long_codes = (
+        df.select(record_id, *code_cols)
+        .unpivot(index=record_id, on=code_cols)
+        .with_columns(pl.col("value").cast(pl.String))
+        .filter(pl.col("value").is_not_null() & (pl.col("value") != ""))
+        .select(
+            pl.col(record_id),
+            pl.col("variable")
+            .replace_strict(
+                code_column_types, return_dtype=pl.Enum(["diagnosis", "procedure"])
+            )
+            .alias("clinical_code_type"),
+            pl.col("value")
+            .str.replace_all(r"\W+", "")
+            .str.to_lowercase()
+            .cast(pl.Categorical)
+            .alias("clinical_code"),
+            pl.col("variable")
+            .replace_strict(code_column_positions, return_dtype=pl.Int8)
+            .alias("position"),
+        )
+        .collect(engine="streaming")
+        .to_pandas()
     )
-    long_codes = long_codes.drop(columns=["variable", "value"])
     return long_codes
 
 
@@ -203,53 +361,92 @@ def make_linear_position_scale(long_codes, N=23):
     last secondary, and N+1 is primary, where N is the total
     number of diagnosis or procedure columns.
 
+    Only the position column is replaced in the result (the other
+    columns are not copied).
+
     Testing: not yet tested
     """
-    df = long_codes.copy()
-    df.position = N + 1 - df.position
-    return df
+    return long_codes.assign(position=N + 1 - long_codes["position"].to_numpy())
 
-def make_code_group_counts(long_clinical_codes, raw_episodes_data):
+def make_code_group_counts(
+    long_clinical_codes, raw_episodes_data, codes_files_dir="../codes_files"
+):
     """
     Convert the episodes data into code counts
     
     Use the approximately 50 diagnosis and procedure
     columns in raw_episodes_data to count the number of
     each code occurring in a code group in each episode.
-    Code groups are currently hard coded to point to the
-    files in ../codes_files/.
+    Code groups are read from the icd10.yaml and opcs4.yaml
+    files in codes_files_dir (by default ../codes_files/,
+    relative to the working directory).
     
     The input dataset needs an episode_id column and columns
     of the form diagnosis_n, procedure_n where n runs from
     0 (primary) to N. 
     """
     code_groups = codes.get_code_groups(
-        "../codes_files/icd10.yaml", "../codes_files/opcs4.yaml"
+        os.path.join(codes_files_dir, "icd10.yaml"),
+        os.path.join(codes_files_dir, "opcs4.yaml"),
     )
 
-    # Count the total number of clinical code groups in each episode. This is
-    # achieved by joining the names of the code groups onto the long codes
-    # where the type (diagnosis or procedure) matches and also the normalised
-    # code (e.g. i211) matches. The groups are pivoted to become columns,
-    # with values equal to the number of occurrences of each group in each
-    # episode. Due to the inner join of groups onto episodes, any episode with
-    # no codes in a group will be dropped. These must be added back on at
-    # the end as zero rows.
-    code_group_counts = (
-        long_clinical_codes.merge(
-            code_groups,
-            how="inner",
-            left_on=["clinical_code_type", "clinical_code"],
-            right_on=["type", "name"],
-        )[["episode_id", "group"]]
-        .pivot_table(index="episode_id", columns="group", aggfunc=len, fill_value=0)
-        .merge(raw_episodes_data["episode_id"], how="right", on="episode_id")
-        .fillna(0)
+    # Give each (type, code) pair an integer key, using the categories of
+    # the long codes (categorical if they come from convert_codes_to_long,
+    # in which case this does not hash any strings). The code groups are
+    # encoded with the same categories, so codes that do not occur in the
+    # episodes get a code of -1 and are dropped.
+    code_type = pd.Categorical(long_clinical_codes["clinical_code_type"])
+    code = pd.Categorical(long_clinical_codes["clinical_code"])
+    num_keys = len(code_type.categories) * len(code.categories)
+    key = code_type.codes.astype(np.int64) * len(code.categories) + code.codes
+
+    group_type = pd.Categorical(code_groups["type"], categories=code_type.categories)
+    group_code = pd.Categorical(code_groups["name"], categories=code.categories)
+    present = (group_type.codes != -1) & (group_code.codes != -1)
+    group_key = (
+        group_type.codes[present].astype(np.int64) * len(code.categories)
+        + group_code.codes[present]
     )
-    
+    group_index, group_names = pd.factorize(
+        code_groups["group"].to_numpy()[present], sort=True
+    )
+
+    # Count the total number of clinical code groups in each episode. A
+    # code can be in more than one group, so instead of joining the groups
+    # onto the long codes (a hash join on two string columns over every
+    # code), make a sparse (episode x key) matrix of code counts and a
+    # sparse (key x group) indicator matrix of group membership. Their
+    # product is the number of codes in each group in each episode. Rows
+    # follow raw_episodes_data["episode_id"], so episodes with no codes in
+    # any group are zero rows. Only groups that occur in some episode are
+    # kept (the same columns as counting the joined table would give). An
+    # episode has at most about 50 codes, so the counts are stored as uint8.
+    row = pd.Index(raw_episodes_data["episode_id"]).get_indexer(
+        long_clinical_codes["episode_id"]
+    )
+    keep = (row != -1) & (code_type.codes != -1) & (code.codes != -1)
+    episode_codes = scipy.sparse.csr_matrix(
+        (np.ones(keep.sum(), dtype=np.int32), (row[keep], key[keep])),
+        shape=(len(raw_episodes_data), num_keys),
+    )
+    code_group_membership = scipy.sparse.csr_matrix(
+        (np.ones(len(group_key), dtype=np.int32), (group_key, group_index)),
+        shape=(num_keys, len(group_names)),
+    )
+    counts = (episode_codes @ code_group_membership).tocsc()
+    occurring = np.flatnonzero(np.diff(counts.indptr))
+
+    code_group_counts = pd.DataFrame(
+        counts[:, occurring].astype(np.uint8).toarray(),
+        columns=group_names[occurring],
+    )
+    code_group_counts.insert(
+        0, "episode_id", raw_episodes_data["episode_id"].to_numpy()
+    )
+
     return code_group_counts
 
-def get_raw_episodes_data(start_date, end_date, from_file):
+def get_raw_episodes_data(start_date, end_date, from_file, datasets_dir="datasets"):
     """
     Fetch the raw episodes data (one row per episode), with
     patient_id, age, gender, spell_id, spell and episode start
@@ -259,9 +456,13 @@ def get_raw_episodes_data(start_date, end_date, from_file):
     be ignored.
     
     Use start_date and end_date to limit the range of data 
-    returned. The dataset is saved in datasets/raw_episodes_data.pkl.
-    Set from_file = True to read from this file instead of SQL.
+    returned. The dataset is saved in raw_episodes_dataset.parquet in
+    datasets_dir (by default datasets/, relative to the working
+    directory). Set from_file = True to read from this file instead
+    of SQL. The file is zstd-compressed Parquet, which is smaller and
+    faster to read back than a pickle.
     """
+    path = os.path.join(datasets_dir, "raw_episodes_dataset.parquet")
 
     # Fetch the raw data. 6 years of data takes 283 s to fetch (from home),
     # so estimating full datasets takes about 1132 s. Same query took 217 s
@@ -272,30 +473,53 @@ def get_raw_episodes_data(start_date, end_date, from_file):
     if not from_file:
         print("Fetching episodes dataset from SQL")
         raw_episodes_data = get_hes_data(start_date, end_date, "episodes")
-        raw_episodes_data.to_pickle("datasets/raw_episodes_dataset.pkl")
+        raw_episodes_data.to_parquet(
+            path, compression="zstd", row_group_size=100_000
+        )
     else:
         print("Reading episodes dataset from file")
-        raw_episodes_data = pd.read_pickle("datasets/raw_episodes_dataset.pkl")
+        raw_episodes_data = pd.read_parquet(path)
     
     num_rows = len(raw_episodes_data.index)
     print(f"Dataset contains {num_rows} rows")
+
+    # Store each diagnosis and procedure column as a categorical. There are
+    # only a few thousand distinct codes, so an integer code per cell (with
+    # each distinct string stored once) uses much less memory than a string
+    # per cell, and missing codes are code -1 rather than a Python object
+    code_cols = [s for s in raw_episodes_data.columns if s in code_column_types]
+    raw_episodes_data[code_cols] = raw_episodes_data[code_cols].astype("category")
+
+    # Replace empty strings with NaN. In the code columns, this is done by
+    # removing the "" category (which only touches the categories, not
+    # the cells). Otherwise, only the other string columns (e.g. gender)
+    # are searched, not the ids, dates and numeric columns
+    for col in code_cols:
+        if "" in raw_episodes_data[col].cat.categories:
+            raw_episodes_data[col] = raw_episodes_data[col].cat.remove_categories("")
+    string_cols = raw_episodes_data.select_dtypes(include=["object", "string"]).columns
+    raw_episodes_data[string_cols] = raw_episodes_data[string_cols].replace("", np.nan)
     
-    # Replace empty string with NaN across the dataset
-    raw_episodes_data.replace("", np.nan, inplace=True)
-    
-    # Store the episode id explicitly as a column
-    raw_episodes_data["episode_id"] = raw_episodes_data.index
+    # Store the episode id explicitly as a column. The episode id is
+    # used as a join key throughout, so store it in the narrowest integer
+    # type that fits (int32 for the full dataset)
+    raw_episodes_data["episode_id"] = pd.to_numeric(
+        raw_episodes_data.index, downcast="integer"
+    )
     
     # Ensure that the spell_id column does not contain NaN
     num_empty_spell_id = raw_episodes_data["spell_id"].isnull().sum()
     print(f"Dropping {num_empty_spell_id} rows with missing spell_id")
     raw_episodes_data.dropna(subset="spell_id", inplace=True)
     
-    # Exclude rows where all of the diagnosis/procedure columns are NULL
+    # Exclude rows where all of the diagnosis/procedure columns are NULL.
+    # The missing codes are category code -1, so this only needs to compare
+    # the integer codes of each column (rather than dropna on the frame)
     rows_before_dropping_empty_codes = len(raw_episodes_data.index)
-    pattern = re.compile("(diagnosis|procedure)")
-    code_cols = [s for s in raw_episodes_data.columns if pattern.search(s)]
-    raw_episodes_data.dropna(subset=code_cols, how="all", inplace=True)
+    has_code = np.zeros(len(raw_episodes_data), dtype=bool)
+    for col in code_cols:
+        has_code |= raw_episodes_data[col].cat.codes.to_numpy() != -1
+    raw_episodes_data = raw_episodes_data[has_code]
     num_empty_codes = rows_before_dropping_empty_codes - len(raw_episodes_data.index)
     print(f"Dropped {num_empty_codes} rows missing any diagnosis or procedure code")
     
@@ -322,47 +546,44 @@ def get_index_episodes(code_group_counts, raw_episodes_data):
     Find the index episodes, which are the ones that contain an ACS or PCI and
     are also the first episode of the spell.
     """
-    df = (
-        code_group_counts.merge(
-            raw_episodes_data[["episode_id", "spell_id", "episode_start_date"]],
-            how="left",
-            on="episode_id",
-        )
-        .sort_values("episode_start_date")
-        .groupby("spell_id")
-        .first()
-    )
+    # Everything needed about each episode, in one table keyed by
+    # episode_id, so that the index episodes are looked up with one join
+    # (instead of joining the code group counts, start dates and
+    # demographics onto the index episodes one at a time)
+    count_cols = ["acs_bezin", "pci", "mi_stemi_schnier", "mi_nstemi_schnier"]
+    episodes = raw_episodes_data[
+        ["episode_id", "spell_id", "episode_start_date", "patient_id", "age", "gender"]
+    ].join(code_group_counts.set_index("episode_id")[count_cols], on="episode_id")
+    episodes = episodes.set_index("episode_id", drop=False)
+
+    # Find the first episode of each spell with a per-group idxmin, rather
+    # than sorting all the episodes by start date. The groups are sorted by
+    # spell_id, so the index episodes are in spell_id order (which the
+    # train/test split of the datasets built from them depends on)
+    first_episode_id = episodes.groupby("spell_id", observed=True, sort=True)[
+        "episode_start_date"
+    ].idxmin()
     assert (
-        df.shape[0] == raw_episodes_data.spell_id.nunique()
-    ), "Expecting df to have one row per spell in the original dataset"
-    idx_episodes = (
-        df[(df["acs_bezin"] > 0) | (df["pci"] > 0)]
-        .reset_index()[["episode_id", "spell_id"]]
-        .rename(columns={"episode_id": "idx_episode_id", "spell_id": "idx_spell_id"})
-    )
+        len(first_episode_id) == raw_episodes_data.spell_id.nunique()
+    ), "Expecting one first episode per spell in the original dataset"
+    df = episodes.loc[first_episode_id.to_numpy()]
+    df = df[(df["acs_bezin"] > 0) | (df["pci"] > 0)]
 
     # Calculate information about the index event. All index events are
     # ACS or PCI, so if PCI is not performed then the case is medically
     # managed.
-    df = idx_episodes.merge(
-        code_group_counts, how="left", left_on="idx_episode_id", right_on="episode_id"
-    )
-    idx_episodes["idx_pci_performed"] = df["pci"] > 0
-    idx_episodes["idx_stemi"] = df["mi_stemi_schnier"] > 0
-    idx_episodes["idx_nstemi"] = df["mi_nstemi_schnier"] > 0
-    idx_episodes = (
-        idx_episodes.merge(
-            get_episode_start_dates(raw_episodes_data), how="left", left_on="idx_episode_id", right_on="episode_id"
-        )
-        .merge(get_age_and_gender(raw_episodes_data), how="left", left_on="idx_episode_id", right_on="episode_id")
-        .rename(
-            columns={
-                "episode_start_date": "idx_date",
-                "age": "dem_age",
-                "gender": "dem_gender",
-            }
-        )
-        .filter(regex="(idx_|dem_|patient_id)")
+    idx_episodes = pd.DataFrame(
+        {
+            "idx_episode_id": df["episode_id"].to_numpy(),
+            "idx_spell_id": df["spell_id"].to_numpy(),
+            "idx_pci_performed": (df["pci"] > 0).to_numpy(),
+            "idx_stemi": (df["mi_stemi_schnier"] > 0).to_numpy(),
+            "idx_nstemi": (df["mi_nstemi_schnier"] > 0).to_numpy(),
+            "idx_date": df["episode_start_date"].to_numpy(),
+            "patient_id": df["patient_id"].to_numpy(),
+            "dem_age": df["age"].to_numpy(),
+            "dem_gender": df["gender"].to_numpy(),
+        }
     )
     return idx_episodes
 
@@ -372,11 +593,9 @@ def get_episodes_before_index(time_to_episode, min_period_before, max_period_bef
     These are the episodes whose clinical code counts should contribute
     to predictors.
     """
-    df = time_to_episode[
-        (time_to_episode["index_to_episode_time"] < -min_period_before)
-        & (-max_period_before < time_to_episode["index_to_episode_time"])
-    ]
-    return df[["idx_episode_id", "episode_id"]]
+    time = time_to_episode["index_to_episode_time"]
+    mask = (time < -min_period_before) & (-max_period_before < time)
+    return time_to_episode.loc[mask, ["idx_episode_id", "episode_id"]]
 
 def calculate_time_to_episode(idx_episodes, raw_episodes_data):
     """
@@ -384,7 +603,11 @@ def calculate_time_to_episode(idx_episodes, raw_episodes_data):
     up with all the patient's other episodes. This can be used to find which other
     episodes are inside an appropriate window before and after the index event
     """
-    df = idx_episodes.merge(get_episode_start_dates(raw_episodes_data), how="left", on="patient_id")
+    # Only the columns needed for the time difference are joined, because
+    # the join has one row per pair of index event and patient episode
+    df = idx_episodes[["idx_episode_id", "idx_date", "patient_id"]].merge(
+        get_episode_start_dates(raw_episodes_data), how="left", on="patient_id"
+    )
     df["index_to_episode_time"] = df["episode_start_date"] - df["idx_date"]
     return df[["idx_episode_id", "episode_id", "index_to_episode_time"]]
     
@@ -393,14 +616,19 @@ def get_code_groups_before_index(episodes_before_idx, code_group_counts, idx_epi
     Compute the total count for each index event that has an episode
     in the valid window before the index.
     """
+    # Index events with no episodes before the index are added back
+    # on as zero rows by the reindex. The counts over the window before
+    # the index are small, so they are stored as uint16 (instead of the
+    # int64 returned by the sum).
     return (
         episodes_before_idx.merge(code_group_counts, how="left", on="episode_id")
         .drop(columns="episode_id")
-        .groupby("idx_episode_id")
+        .groupby("idx_episode_id", observed=True, sort=False)
         .sum()
         .add_suffix("_before")
-        .merge(idx_episodes["idx_episode_id"], how="right", on="idx_episode_id")
-        .fillna(0)
+        .reindex(idx_episodes["idx_episode_id"], fill_value=0)
+        .astype(np.uint16)
+        .reset_index()
     )
     
 def get_all_codes_before_index(episodes_before_idx, long_clinical_codes, idx_episodes):
@@ -414,14 +642,19 @@ def get_all_codes_before_index(episodes_before_idx, long_clinical_codes, idx_epi
     when the code occurred. This is the simplest thing to start with.
     """
     df = episodes_before_idx.merge(long_clinical_codes, on="episode_id")
-    df["full_code"] = df["clinical_code_type"] + "_" + df["clinical_code"]
+    # The code columns may be categorical, which do not support +
+    df["full_code"] = (
+        df["clinical_code_type"].astype(str) + "_" + df["clinical_code"].astype(str)
+    )
     long_codes_before = df[["idx_episode_id", "full_code"]].drop_duplicates()
+    # Index episodes with no codes before the index are included as
+    # all-zero rows by sparse_encode, so the result stays sparse
     return (
-        spe.sparse_encode(long_codes_before, "idx_episode_id")
+        spe.sparse_encode(
+            long_codes_before, "idx_episode_id", idx_episodes["idx_episode_id"]
+        )
         .rename_axis("idx_episode_id")
         .reset_index()
-        .merge(idx_episodes["idx_episode_id"], how="right", on="idx_episode_id")
-        .fillna(0)
     )
     
 def get_censor_dates(raw_episodes_data):
@@ -442,12 +675,11 @@ def get_episodes_after_index(time_to_episode, min_period_after, follow_up):
     These are the subsequent episodes after the index, with
     the index row also retained.
     """
-    return time_to_episode[
-        # Exclude a short window after the index
-        (time_to_episode["index_to_episode_time"] > min_period_after)
-        # Drop events after the follow up period
-        & (follow_up > time_to_episode["index_to_episode_time"])
-    ][["idx_episode_id", "episode_id"]]
+    time = time_to_episode["index_to_episode_time"]
+    # Exclude a short window after the index, and drop events after
+    # the follow up period
+    mask = (time > min_period_after) & (follow_up > time)
+    return time_to_episode.loc[mask, ["idx_episode_id", "episode_id"]]
     
     
 def make_outcomes(outcome_groups, idx_episodes, episodes_after_index, code_group_counts):
@@ -457,23 +689,26 @@ def make_outcomes(outcome_groups, idx_episodes, episodes_after_index, code_group
     (outcome_groups)
     """
 
+    # Only the outcome groups are needed, so select them before the join
+    # (instead of summing every code group and then discarding most of
+    # them). Index events with no episodes after the index are added back
+    # on as zero rows by the reindex.
     code_counts_after = (
-        episodes_after_index.merge(code_group_counts, how="left", on="episode_id")
+        episodes_after_index.merge(
+            code_group_counts[["episode_id", *outcome_groups]],
+            how="left",
+            on="episode_id",
+        )
         .drop(columns="episode_id")
-        .groupby("idx_episode_id")
+        .groupby("idx_episode_id", observed=True, sort=False)
         .sum()
-        .filter(outcome_groups)
         .add_suffix("_outcome")
-        .merge(idx_episodes["idx_episode_id"], how="right", on="idx_episode_id")
-        .fillna(0)
+        .reindex(idx_episodes["idx_episode_id"], fill_value=0)
+        # Reduce the outcome to a True if > 0 or False if == 0
+        .astype(bool)
+        .reset_index()
     )
 
-    for outcome_group in outcome_groups:
-        # Reduce the outcome to a True if > 0 or False if == 0
-        code_counts_after[outcome_group + "_outcome"] = code_counts_after[
-            outcome_group + "_outcome"
-        ].astype(bool)
-        
     return code_counts_after
 
 def make_dataset_from_features(idx_episodes, features, outcome_counts, all_cause_death):
@@ -483,11 +718,21 @@ def make_dataset_from_features(idx_episodes, features, outcome_counts, all_cause
     from the dataset which uses all codes as features.
     """
     # Note: it is important to have the features dataframe first, because it
-    # might be sparse, and we want to preserve the sparsity.
-    return (
-        features.merge(idx_episodes, how="left", on="idx_episode_id")
-        .merge(outcome_counts, how="left", on="idx_episode_id")
-        .merge(all_cause_death, how="left", on="idx_episode_id")
-        .set_index("idx_episode_id")
-        .drop(columns=["idx_spell_id", "patient_id"])
-    )
\ No newline at end of file
+    # might be sparse, and we want to preserve the sparsity. The id columns
+    # that are not needed are dropped before joining, instead of being
+    # carried through (the result can have thousands of columns). All the
+    # tables have one row per idx_episode_id and disjoint columns, so they
+    # are placed side by side with a column-wise concat (which does not
+    # hash the keys when the indexes are identical) instead of merges.
+    features = features.set_index("idx_episode_id")
+    return pd.concat(
+        [
+            features,
+            idx_episodes.drop(columns=["idx_spell_id", "patient_id"]).set_index(
+                "idx_episode_id"
+            ),
+            outcome_counts.set_index("idx_episode_id"),
+            all_cause_death.set_index("idx_episode_id"),
+        ],
+        axis=1,
+    ).reindex(features.index)
\ No newline at end of file
@@ -4,8 +4,19 @@
 #
 
 import os
-
-os.chdir("scripts/prototypes")
+import sys
+import pathlib
+
+# Find the code files relative to this script, instead of changing the
+# working directory (see datasets.py)
+try:
+    prototypes_dir = pathlib.Path(__file__).resolve().parent
+except NameError:
+    prototypes_dir = pathlib.Path("scripts/prototypes").resolve()
+codes_files_dir = prototypes_dir.parent / "codes_files"
+icd10_file = str(codes_files_dir / "icd10.yaml")
+opcs4_file = str(codes_files_dir / "opcs4.yaml")
+sys.path.insert(0, str(prototypes_dir))
 
 import importlib
 import numpy as np
@@ -16,6 +27,7 @@ import umap
 import umap.plot
 import re
 import scipy
+from sklearn.decomposition import TruncatedSVD
 import py_hbr
 from py_hbr.clinical_codes import get_codes_in_group, ClinicalCodeParser
 import code_group_counts as codes
@@ -24,10 +36,11 @@ import sparse_encode as spe
 
 import hes
 
-importlib.reload(hes)
-importlib.reload(codes)
-importlib.reload(py_hbr)
-importlib.reload(spe)
+if os.environ.get("DEV_RELOAD"):
+    importlib.reload(hes)
+    importlib.reload(codes)
+    importlib.reload(py_hbr)
+    importlib.reload(spe)
 
 # Get raw data
 start_date = dt.date(2023,1,1)
@@ -58,8 +71,12 @@ reduced = hes.convert_codes_to_long(reduced)
 # multiple positions. Keep onlt the highest priority code (the one
 # with the lowest code position). This might arise due to aggregating
 # the spells from underlying episodes, depending on the method that
-# was used.
-reduced = reduced.groupby(["spell_id", "full_code"]).min().reset_index()
+# was used. A stable sort by position followed by drop_duplicates keeps
+# the first (lowest position) row of each spell/code pair, without a
+# per-group reduction over every column.
+reduced = reduced.sort_values("position", kind="stable").drop_duplicates(
+    ["spell_id", "full_code"], keep="first"
+)
 
 # Map the position onto the following linear scale: primary diagnosis
 # is 24, through secondary_diagnosis_23 is 1 (same for procedure). The
@@ -96,12 +113,12 @@ dummy_data_to_reduce = scipy.sparse.csr_matrix(dummy_data_to_reduce.values)
 # Get the age column in the same order as the data to reduce
 dummy_ordered_age = dummy_encoded.merge(age_and_gender, on="spell_id").age
 
-code_groups = codes.get_code_groups("../codes_files/icd10.yaml", "../codes_files/opcs4.yaml")
+code_groups = codes.get_code_groups(icd10_file, opcs4_file)
 
 # ... get other values to plot on embedding here
 def get_code_group_labels(reduced, code_group):
-    group = get_codes_in_group("../codes_files/opcs4.yaml", code_group)
-    group = "icd10_" + group.name.apply(hes.normalise_code)
+    group = get_codes_in_group(opcs4_file, code_group)
+    group = "icd10_" + codes.normalise_codes(group.name)
     df = reduced.copy()
     df["ingroup"] = df.full_code.isin(group)
     group = df.groupby("spell_id").ingroup.any()
@@ -186,12 +203,32 @@ linear_ordered_age = linear_encoded.merge(age_and_gender, on="spell_id").age
 #   Here, there is one binary column per clinical code, and two rows
 #   (spells) are considered different according to how many of their
 #   clinical codes differ -- this is the Hamming distance.
+#
+# Computing Hamming distances over thousands of code columns makes the
+# nearest-neighbour search slow. Instead, the sparse code matrix is first
+# reduced to 128 dense float32 components using a truncated SVD, and
+# UMAP uses the Euclidean distance between those (low_memory bounds
+# the memory used by the nearest-neighbour descent).
+svd_data_to_reduce = (
+    TruncatedSVD(n_components=128, random_state=1)
+    .fit_transform(dummy_data_to_reduce)
+    .astype(np.float32)
+)
 
-dummy_mapper = umap.UMAP(metric="hamming", random_state=1, verbose=True)
-embedding = dummy_mapper.fit_transform(dummy_data_to_reduce)
-
-mapper3 = umap.UMAP(metric="hamming", random_state=1, verbose=True, n_components = 3)
-embedding3 = mapper3.fit_transform(dummy_data_to_reduce)
+dummy_mapper = umap.UMAP(
+    metric="euclidean", n_neighbors=15, random_state=1, low_memory=True, verbose=True
+)
+embedding = dummy_mapper.fit_transform(svd_data_to_reduce)
+
+mapper3 = umap.UMAP(
+    metric="euclidean",
+    n_neighbors=15,
+    random_state=1,
+    low_memory=True,
+    verbose=True,
+    n_components=3,
+)
+embedding3 = mapper3.fit_transform(svd_data_to_reduce)
 
 # Helper for plotting distributions (3D)
 def plot_discrete_groups(embedding, reduced, groups, colour_map, title):
@@ -220,7 +257,7 @@ def plot_discrete_groups(embedding, reduced, groups, colour_map, title):
     plt.legend()
     plt.show()
 
-code_parser = ClinicalCodeParser("../codes_files/icd10.yaml", "../codes_files/opcs4.yaml")
+code_parser = ClinicalCodeParser(icd10_file, opcs4_file)
 
 # Plot basic embedding###################
 # fig = plt.figure()
@@ -52,12 +52,26 @@
 # - Any centering and scaling, which is a global operation.
 #
 
+# Optionally (if the USE_SKLEARNEX environment variable is set), use the
+# Intel extension for scikit-learn to run the estimators that it supports
+# (e.g. logistic regression with lbfgs, random forests) on its optimised
+# kernels. This is opt-in because it replaces the implementation of the
+# estimators for the whole process, so results can differ slightly from
+# plain scikit-learn. It must happen before the estimators are imported.
+import os
+
+if os.environ.get("USE_SKLEARNEX"):
+    from sklearnex import patch_sklearn
+
+    patch_sklearn()
+    print("Using the Intel extension for scikit-learn (USE_SKLEARNEX is set)")
+
 from sklearn.linear_model import LogisticRegression
 from sklearn.svm import LinearSVC
 from sklearn.naive_bayes import GaussianNB
 from sklearn.tree import DecisionTreeClassifier, plot_tree
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.ensemble import GradientBoostingClassifier, HistGradientBoostingClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.impute import SimpleImputer
@@ -74,6 +88,17 @@ from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
 import umap
 from sklearn.decomposition import TruncatedSVD
 from scipy.stats import uniform
+import scipy.sparse
+
+
+def make_scaler(X):
+    """
+    Make the StandardScaler for a pipeline that will be fitted to X.
+    If X is a sparse matrix (e.g. the all-codes dataset), the features
+    are only scaled, not centered, because centering would make every
+    zero nonzero and convert X to a dense matrix.
+    """
+    return StandardScaler(with_mean=not scipy.sparse.issparse(X))
 
 
 # This should go inside each class, but for now it is just a dictionary to
@@ -120,7 +145,7 @@ class SimpleLogisticRegression:
             ],
             remainder="passthrough",
         )
-        scaler = StandardScaler()
+        scaler = make_scaler(X)
         # Many columns, particularly in the SWD, contain missing values. after
         # conversion to numeric. These are imputed because the scikit-learn
         # logistic regression implementation does not handle NaN by default.
@@ -249,12 +274,14 @@ class SimpleDecisionTree:
         )
         impute = SimpleImputer()
         tree = DecisionTreeClassifier()
+        # If there are no object columns, then omit the step
+        # which converts to numeric
         if len(object_column_indices) == 0:
+            self._pipe = Pipeline([("impute", impute), ("tree", tree)])
+        else:
             self._pipe = Pipeline(
                 [("to_numeric", to_numeric), ("impute", impute), ("tree", tree)]
             )
-        else:
-            self._pipe = Pipeline([("impute", impute), ("tree", tree)])
 
         self._param_grid = {"tree__max_depth": range(1, 15)}
         self._search = GridSearchCV(
@@ -425,7 +452,7 @@ class SimpleLinearSvc:
             ],
             remainder="passthrough",
         )
-        scaler = StandardScaler()
+        scaler = make_scaler(X)
         impute = SimpleImputer()
         svc = LinearSVC(verbose=0)
         self._pipe = Pipeline(
@@ -500,7 +527,23 @@ class SimpleGradientBoostedTree:
             remainder="passthrough",
         )
         impute = SimpleImputer()
-        tree = GradientBoostingClassifier()
+        # The histogram-based implementation bins each feature once (into at
+        # most 255 bins), instead of sorting the feature values to find every
+        # split, which is much faster for large datasets. It does not accept
+        # sparse matrices, so sparse features use the exact implementation.
+        # It is only an approximate substitute for GradientBoostingClassifier:
+        # the splits are searched over the bins, and leaves need at least 20
+        # samples (min_samples_leaf), so the fitted trees differ. The leaf
+        # limit and early stopping are turned off so that at least max_depth
+        # and the number of iterations mean the same thing (otherwise at most
+        # 31 leaves make the larger max_depth values identical, and 10% of
+        # the training data is held out to stop early).
+        if scipy.sparse.issparse(X):
+            tree = GradientBoostingClassifier()
+        else:
+            tree = HistGradientBoostingClassifier(
+                max_leaf_nodes=None, early_stopping=False
+            )
         if len(object_column_indices) == 0:
             self._pipe = Pipeline(
                 [
@@ -524,8 +567,6 @@ class SimpleGradientBoostedTree:
         ).fit(X, y)
         print(self._search.best_params_)
 
-        self._pipe.fit(X, y)
-
     def model(self):
         return self._search.best_estimator_
 
@@ -536,7 +577,10 @@ model_description[SimpleGradientBoostedTree.name()] = (
     "The model is fitted by one-hot encoding catagorical features, "
     "centering and scaling predictors, and imputing missing values "
     "using the training set mean. A gradient boosted tree is fitted using "
-    "the maximum tree depth as a tuned hyperparameter."
+    "the maximum tree depth as a tuned hyperparameter. For dense features, "
+    "the histogram-based implementation is used (features are binned into "
+    "at most 255 bins, with at least 20 samples per leaf); for sparse "
+    "features, the exact implementation is used."
 )
 
 class SimpleNeuralNetwork:
@@ -553,7 +597,7 @@ class SimpleNeuralNetwork:
             ],
             remainder="passthrough",
         )
-        scaler = StandardScaler()
+        scaler = make_scaler(X)
         impute = SimpleImputer()
         nn = MLPClassifier(
             solver="sgd",
@@ -1,8 +1,14 @@
 import sqlalchemy as sql
 import pandas as pd
+import numpy as np
 import time
 import re
-from code_group_counts import normalise_code
+from code_group_counts import normalise_codes
+import raw_load
+
+# Matches the names of the cause of death columns in the query below
+# (e.g. cause_of_death_0), capturing the position
+cause_of_death_column_regex = re.compile(r"^cause_of_death_(\d+)$")
 
 def make_mortality_query(start_date, end_date):
     return (
@@ -35,7 +41,7 @@ def get_mortality_data(start_date, end_date):
 
     con = sql.create_engine("mssql+pyodbc://xsw")
     start = time.time()
-    raw_data = pd.read_sql(make_mortality_query(start_date, end_date), con)
+    raw_data = raw_load.read_sql(make_mortality_query(start_date, end_date), con)
     stop = time.time()
     print(f"Time to fetch mortality data: {stop - start}")
     return raw_data
@@ -49,26 +55,25 @@ def convert_codes_to_long(df):
     
     Testing: not yet tested
     """
-    pattern = re.compile("cause_of_death")
-    code_cols = [s for s in df.columns if pattern.search(s)]
-
-    # Pivot all the diagnosis and procedure codes into one
-    # columns. Consider https://stackoverflow.com/questions/47684961/
-    # melt-uneven-data-in-columns-and-ignore-nans-using-pandas
-    # for speed.
-    
-    long_codes = pd.melt(df, id_vars=["patient_id"], value_vars=code_cols).dropna()
+    matches = [cause_of_death_column_regex.match(col) for col in df.columns]
+    matches = [m for m in matches if m is not None]
+    code_cols = [m.string for m in matches]
 
-    long_codes["value"] = long_codes["value"].apply(normalise_code)
-    # Prepend icd10 or opc4 to the codes to indicate which are which
-    # (because some codes appear in both ICD-10 and OPCS-4)
-    long_codes["cause_of_death"] = long_codes.value
-    long_codes["position"] = (
-        long_codes["variable"]
-        .replace("cause_of_death_", "", regex=True)
-        .astype(int)
+    # Pivot the cause of death codes into one column. The code columns
+    # are read into one (patients x codes) array, and the row and column
+    # index of every non-missing code picks out the patient_id, code and
+    # position directly (instead of melting every cell, and then dropping
+    # the missing ones)
+    codes = df[code_cols].to_numpy()
+    rows, cols = np.nonzero(pd.notna(codes))
+    positions = np.array([int(m.group(1)) for m in matches], dtype=np.int8)
+    long_codes = pd.DataFrame(
+        {
+            "patient_id": df["patient_id"].to_numpy()[rows],
+            "cause_of_death": normalise_codes(pd.Series(codes[rows, cols])),
+            "position": positions[cols],
+        }
     )
-    long_codes = long_codes.drop(columns=["variable", "value"])
     return long_codes
 
 def get_all_cause_death(idx_episodes, mortality_dates, follow_up):
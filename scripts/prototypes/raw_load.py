@@ -0,0 +1,194 @@
+import datetime
+import decimal
+import importlib.util
+import os
+import shutil
+import subprocess
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+
+# Map from the Python types reported by pyodbc in cursor.description to
+# the Arrow types used to parse the bcp output. Any other type is read
+# as a string.
+_pyodbc_to_arrow_type = {
+    str: pa.string(),
+    int: pa.int64(),
+    float: pa.float64(),
+    decimal.Decimal: pa.float64(),
+    bool: pa.bool_(),
+    datetime.date: pa.date32(),
+    datetime.datetime: pa.timestamp("ms"),
+}
+
+# bcp character mode writes NULL as an empty field and an empty string
+# as a single NUL character. Both are read as missing values (the
+# datasets replace empty strings with NaN anyway). The field terminator
+# is the ASCII unit separator, which does not appear in the data.
+_field_terminator = "\x1f"
+_null_values = ["", "\x00"]
+
+
+def bcp_available():
+    """
+    Check whether the SQL Server bcp utility is on the PATH.
+    """
+    return shutil.which("bcp") is not None
+
+
+def get_column_types(query, con):
+    """
+    Get the column names and Arrow types of the result of query,
+    without fetching any rows, using the types pyodbc reports for
+    an empty result. The result is a pyarrow.Schema.
+    """
+    raw_con = con.raw_connection()
+    try:
+        cursor = raw_con.cursor()
+        cursor.execute(f"select top 0 * from ({query}) as q")
+        fields = [
+            (column[0], _pyodbc_to_arrow_type.get(column[1], pa.string()))
+            for column in cursor.description
+        ]
+    finally:
+        raw_con.close()
+    return pa.schema(fields)
+
+
+def read_sql_bcp(query, con):
+    """
+    Fetch the result of query using the bcp utility (queryout, in
+    character mode), instead of fetching the rows through pyodbc.
+    bcp uses the SQL Server bulk-copy protocol, which is several times
+    faster than fetching large results row by row.
+
+    The server is the ODBC data source name in the host part of the
+    sqlalchemy engine con (e.g. xsw in mssql+pyodbc://xsw), and a
+    trusted connection is used. The result is written to a temporary
+    file, which is parsed with pyarrow using the column types of the
+    query, and returned as a pandas dataframe (the same as
+    pd.read_sql).
+    """
+    schema = get_column_types(query, con)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "query.dat")
+        # Include bcp's error messages in the exception (the
+        # CalledProcessError message only contains the exit code)
+        try:
+            subprocess.run(
+                [
+                    "bcp",
+                    query,
+                    "queryout",
+                    path,
+                    # Interpret the server (-S) as an ODBC data source name
+                    "-D",
+                    "-S",
+                    con.url.host,
+                    # Trusted connection
+                    "-T",
+                    # Character mode, with the field terminator above
+                    "-c",
+                    "-t",
+                    _field_terminator,
+                    # Largest network packet size
+                    "-a",
+                    "32576",
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(
+                f"bcp failed with exit code {e.returncode}: {e.stderr or e.stdout}"
+            ) from e
+        table = csv.read_csv(
+            path,
+            read_options=csv.ReadOptions(column_names=schema.names),
+            parse_options=csv.ParseOptions(
+                delimiter=_field_terminator, quote_char=False
+            ),
+            convert_options=csv.ConvertOptions(
+                column_types=schema,
+                null_values=_null_values,
+                strings_can_be_null=True,
+            ),
+        )
+    return table.to_pandas(date_as_object=False)
+
+
+def connectorx_available():
+    """
+    Check whether the connectorx package is installed.
+    """
+    return importlib.util.find_spec("connectorx") is not None
+
+
+def read_sql_connectorx(query, uri):
+    """
+    Fetch the result of query using connectorx, which fetches the
+    result into Arrow columns (in Rust), instead of converting each
+    row to Python objects as pyodbc does. The uri is a connectorx
+    connection string (e.g. mssql://server/database?trusted_connection=true).
+    The result is returned as a pandas dataframe (the same as
+    pd.read_sql).
+
+    The query is not partitioned, because the HES tables do not have
+    a numeric key to partition on (connectorx can only split a query
+    on a numeric column).
+    """
+    import connectorx as cx
+
+    table = cx.read_sql(uri, query, return_type="arrow")
+    return table.to_pandas(date_as_object=False)
+
+
+# The query is passed to bcp on the command line, which is limited to
+# 32767 characters on Windows. Longer queries (e.g. the attributes query
+# with a long list of patient ids) are fetched with pd.read_sql instead.
+_max_bcp_query_length = 30000
+
+
+# Number of rows converted to a dataframe at a time by read_sql_chunked
+_chunk_size = 100_000
+
+
+def read_sql_chunked(query, con):
+    """
+    Fetch the result of query using pd.read_sql, but converting the
+    rows to dataframes chunk by chunk, and then concatenating the chunks.
+    Without a chunksize, all the rows are fetched into a list of Python
+    tuples before the dataframe is made, which needs several times the
+    memory of the final dataframe for the large HES tables.
+
+    The query is run with stream_results, so that drivers which support
+    server-side cursors do not buffer the whole result in the client
+    either (for the others, the option is ignored, and the rows are
+    still fetched one chunk at a time).
+    """
+    with con.connect().execution_options(stream_results=True) as connection:
+        chunks = pd.read_sql(query, connection, chunksize=_chunk_size)
+        return pd.concat(chunks, ignore_index=True)
+
+
+def read_sql(query, con, uri=None):
+    """
+    Fetch the result of query into a pandas dataframe. If a
+    connectorx uri is given and connectorx is installed, it is
+    used to fetch the data (see read_sql_connectorx). Otherwise,
+    bcp is used (see read_sql_bcp) if it is installed and the query
+    is short enough to pass on the command line, and pd.read_sql
+    (using the sqlalchemy engine con, see read_sql_chunked) otherwise.
+    The method used is printed, because it depends on what is installed.
+    """
+    if uri is not None and connectorx_available():
+        print("Fetching with connectorx")
+        return read_sql_connectorx(query, uri)
+    if bcp_available() and len(query) <= _max_bcp_query_length:
+        print("Fetching with bcp")
+        return read_sql_bcp(query, con)
+    print("Fetching with pd.read_sql")
+    return read_sql_chunked(query, con)
@@ -4,8 +4,8 @@ import pandas as pd
 import yaml
 import re
 import pickle
-from scipy.sparse import csr_matrix
 import numpy as np
+import sparse_encode as spe
 
 
 def current_commit():
@@ -54,24 +54,52 @@ def save_fit_info(model, name):
         pickle.dump(model, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-def save_dataset(dataset, name):
+def save_dataset(dataset, name, datasets_dir="datasets"):
     """
     Saves a pandas dataframe to a file in the datasets/
-    folder, using a filename with the current timestamp
-    and the current commit hash.
+    folder (or datasets_dir, if given), using a filename
+    with the current timestamp and the current commit hash.
+
+    The dataset is saved as a zstd-compressed Parquet file,
+    which is smaller and faster to load than a pickle, and
+    allows only some columns to be read (see read_dataset_file).
+    Parquet cannot store pandas sparse columns, so datasets
+    containing sparse columns (e.g. the all-codes features)
+    are still saved as a pickle.
     """
-    datasets_dir = "datasets"
-
     if not os.path.isdir(datasets_dir):
         print("Creating missing folder '{datasets_dir}' for storing dataset")
         os.mkdir(datasets_dir)
 
+    is_sparse = any(isinstance(dtype, pd.SparseDtype) for dtype in dataset.dtypes)
+    extension = "pkl" if is_sparse else "parquet"
+
     # Make the file suffix out of the current git
     # commit hash and the current time
-    filename = f"{name}_{current_commit()}_{current_timestamp()}.pkl"
+    filename = f"{name}_{current_commit()}_{current_timestamp()}.{extension}"
     path = os.path.join(datasets_dir, filename)
 
-    dataset.to_pickle(path)
+    if is_sparse:
+        dataset.to_pickle(path)
+    else:
+        dataset.to_parquet(path, compression="zstd")
+
+
+def read_dataset_file(path, columns=None):
+    """
+    Read a dataset saved by save_dataset, using the file
+    extension to determine the format. For Parquet files,
+    columns can be a list of column names to read (the
+    others are not loaded at all). For pickle files, the
+    whole dataset is loaded and then the columns are
+    selected.
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    dataset = pd.read_pickle(path)
+    if columns is not None:
+        dataset = dataset[columns]
+    return dataset
 
 
 def get_file_list(name, directory = "datasets"):
@@ -89,15 +117,15 @@ def get_file_list(name, directory = "datasets"):
             f"Missing folder '{datasets_dir}'. Check your working directory."
         )
 
-    # Read all the .pkl files in the directory
+    # Read all the .pkl and .parquet files in the directory
     files = pd.DataFrame({"path": os.listdir(datasets_dir)})
 
     # Identify the file name part. The horrible regex matches the 
-    # expression _[commit_hash]_[timestamp].pkl. It is important to
+    # expression _[commit_hash]_[timestamp].(pkl|parquet). It is important to
     # match this part, because "anything" can happen in the name part
     # (including underscores and letters and numbers), so splitting on
     # _ would not work. The name can then be removed
-    files["name"] = files["path"].str.replace(r"_([0-9]|[a-zA-Z])*_\d*\.pkl", "", regex=True)
+    files["name"] = files["path"].str.replace(r"_([0-9]|[a-zA-Z])*_\d*\.(pkl|parquet)", "", regex=True)
 
     # Remove all the files whose name does not match, and drop
     # the name from the path
@@ -117,7 +145,7 @@ def get_file_list(name, directory = "datasets"):
         raise RuntimeError(
             "Failed to parse files in the datasets folder. "
             "Ensure that all files have the correct format "
-            "name_commit_timestamp.(rds|pkl), and "
+            "name_commit_timestamp.(rds|pkl|parquet), and "
             "remove any files not matching this "
             "poattern. TODO handle this error properly, "
             "see save_datasets.py."
@@ -130,19 +158,15 @@ def get_file_list(name, directory = "datasets"):
     ]
     return recent_first
 
-def pick_file_interactive(name):
+def pick_file_interactive(name, datasets_dir="datasets"):
     """
-    Print a list of the datasets in the datasets/ folder, along
-    with the date and time it was generated, and the commit hash,
-    and let the user pick which dataset should be loaded interactively.
-    The full filename of the resulting file is returned, which can
-    then be read by the user.
+    Print a list of the datasets in the datasets/ folder (or
+    datasets_dir, if given), along with the date and time it was
+    generated, and the commit hash, and let the user pick which
+    dataset should be loaded interactively. The full filename of
+    the resulting file is returned, which can then be read by the user.
     """
-
-    # Check for missing datasets directory
-    datasets_dir = "datasets"
-
-    recent_first = get_file_list(name)
+    recent_first = get_file_list(name, datasets_dir)
     print(recent_first)
 
     num_datasets = recent_first.shape[0]
@@ -161,29 +185,30 @@ def pick_file_interactive(name):
     full_path = os.path.join(datasets_dir, recent_first.loc[choice, "path"])
     return full_path
 
-def pick_most_recent_file(name):
+def pick_most_recent_file(name, datasets_dir="datasets"):
     """
     Like pick_file_interactive, but automatically selects the most
-    recent file in the datasets/ folder
+    recent file in the datasets/ folder (or datasets_dir, if given)
     """
-    datasets_dir = "datasets"
-    recent_first = get_file_list(name)
+    recent_first = get_file_list(name, datasets_dir)
     full_path = os.path.join(datasets_dir, recent_first.loc[0, "path"])
     return full_path
 
-def load_dataset(name, interactive):
+def load_dataset(name, interactive, columns=None, datasets_dir="datasets"):
     """
-    Load a dataset from the datasets/ folder by name,
-    letting the user interactively pick between different
-    timestamps and commits
+    Load a dataset from the datasets/ folder (or datasets_dir,
+    if given) by name, letting the user interactively pick
+    between different timestamps and commits. Pass a list of
+    column names in columns to only load those columns (see
+    read_dataset_file).
     """
     if interactive:
-        dataset_path = pick_file_interactive(name)
+        dataset_path = pick_file_interactive(name, datasets_dir)
     else:
-        dataset_path = pick_most_recent_file(name)
+        dataset_path = pick_most_recent_file(name, datasets_dir)
         
     print(f"Loading {dataset_path}")
-    return pd.read_pickle(dataset_path)
+    return read_dataset_file(dataset_path, columns)
 
 
 def load_fit_info(name):
@@ -260,7 +285,7 @@ class Dataset:
         else:
             self.dataset_path = pick_most_recent_file(name)
         print(f"Loading {self.dataset_path}")
-        dataset = pd.read_pickle(self.dataset_path)
+        dataset = read_dataset_file(self.dataset_path)
 
         # Load the configuration file
         self.config = load_config_file(config_file)
@@ -305,7 +330,9 @@ class Dataset:
         if sparse_features:
             # Attempt to convert all object columns to numeric
             dataset_features[object_columns] = dataset_features[object_columns].apply(pd.to_numeric, errors='coerce')
-            self._X = csr_matrix(dataset_features.to_numpy())
+            # Convert the sparse columns directly to CSR, without going
+            # through a dense array first
+            self._X = spe.frame_to_csr(dataset_features)
             self.object_column_indices = []
         else:
             self._X = dataset_features.to_numpy()
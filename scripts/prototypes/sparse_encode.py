@@ -35,112 +35,89 @@ def get_column_names(code_to_column):
     return sorted(code_to_column, key=code_to_column.get)
 
 
-def sparse_encode(long_codes, record_id):
+def sparse_encode(long_codes, record_id, record_ids=None):
     """
     The input is a table of codes (full_code
     column) in long format, by the record_id.
-    The output is a sparse matrix, a list of
-    record_id which label the rows, and a list
-    of column names which label the columns.
+    The output is a sparse dataframe with one row
+    per record_id (the index) and one column per
+    code, which is 1 if the code is present in the
+    record and 0 otherwise. Columns are ordered by
+    first appearance of the code (after sorting by
+    record_id).
+
+    If record_ids is None, the rows are the sorted
+    unique values of the record_id column. Otherwise,
+    the rows are record_ids in the order given,
+    and records with no codes are all-zero rows (this
+    avoids merging the sparse result back onto a full
+    list of records afterwards, which densifies it).
+    A ValueError is raised if a record_id is not
+    present in record_ids.
 
     Note that this function requires unique codes
     within each group, otherwise a value error will
     be raised.
 
-    The reason for doing this manually is that I
-    could not figure out how to make pandas pivot
-    into a wide sparse format. If that is possible,
-    this function is not needed.
+    The matrix is built directly in CSR format from
+    the (row, column) index of each code, which are
+    found using pd.factorize (rather than iterating
+    over the rows of long_codes).
     """
-    sorted_by_record = long_codes.sort_values(record_id)
-
-    lil_matrix_rows = []
-    lil_matrix_data = []
-
-    # A map from a code in the full_code column to
-    # a column index. This grows as more codes are
-    # encountered while traversing the table
-    code_to_column = {}
-
-    # This variable tracks the current spell_id and
-    # indicates when a particular row is finished. Note
-    # min is still required as index has not changed by
-    # sort
-    current_id = sorted_by_record[record_id].min()
-    current_lil_matrix_row = []
-    current_lil_matrix_data = []
-
-    # Will be returned as the "row order", so that the
-    # caller can determine which rows correspond to which
-    # spells
-    record_ids = []
-
-    for _, row in sorted_by_record.iterrows():
-        id = row[record_id]
-
-        # print(current_spell_id, spell_id)
-        if current_id != id:
-            # print("Next spell")
-            # Append the row for this spell (constructed
-            # in previous iterations of the for loop) to
-            # the main list of lists
-            # print(current_lil_matrix_row, current_lil_matrix_data)
-
-            # Record the spell id as a row identifier
-            record_ids.append(current_id)
-
-            lil_matrix_rows.append(current_lil_matrix_row)
-            lil_matrix_data.append(current_lil_matrix_data)
-
-            # Reset the rows
-            current_lil_matrix_row = []
-            current_lil_matrix_data = []
-
-            # Update the current spell
-            current_id = id
-
-        # Get the code
-        full_code = row["full_code"]
-
-        column_index = get_column_index(code_to_column, full_code)
-
-        # Check that this column index has not been seen
-        # before. If it has, then there is a duplicate value
-        # in the data -- raise a value error
-        if column_index in current_lil_matrix_row:
-            raise ValueError(f"Found duplicate code {full_code} in record {id}")
-
-        # Append the column index and data to the current
-        # list
-        current_lil_matrix_row.append(column_index)
-        # Append the column data. This is either the
-        # linear code position, or just a TRUE/FALSE
-        # marker if dummy encoding. (TODO)
-        # current_lil_matrix_data.append(position)
-        current_lil_matrix_data.append(True)
-
-    # The last set of rows/data will not have been pushed
-    # to the main arrays at the end of the for loop. Do it
-    # here.
-    record_ids.append(current_id)
-    lil_matrix_rows.append(current_lil_matrix_row)
-    lil_matrix_data.append(current_lil_matrix_data)
-
-    # Find matrix dimensions
-    num_rows = len(lil_matrix_rows)
-    num_cols = len(code_to_column)
-
-    # print(f"Rows: {lil_matrix_rows}")
-    # print(f"nzv: {lil_matrix_data}")
-
-    # Create the sparse matrix
-    mat = scipy.sparse.lil_matrix((num_rows, num_cols), dtype=np.float32)
-    # Need to specify that the elements in the numpy arrays are
-    # numpy objects (it is a linked list, not an array)
-    mat.rows = np.array(lil_matrix_rows, dtype=object)
-    mat.data = np.array(lil_matrix_data, dtype=object)
-
-    column_names = get_column_names(code_to_column)
+    sorted_by_record = long_codes.sort_values(record_id, kind="stable")
+
+    duplicates = sorted_by_record.duplicated([record_id, "full_code"])
+    if duplicates.any():
+        duplicate = sorted_by_record[duplicates].iloc[0]
+        raise ValueError(
+            f"Found duplicate code {duplicate['full_code']} in record {duplicate[record_id]}"
+        )
+
+    column_index, column_names = pd.factorize(sorted_by_record["full_code"])
+    if record_ids is None:
+        # Sorted, so the rows are in increasing record_id order
+        row_index, record_ids = pd.factorize(sorted_by_record[record_id])
+    else:
+        record_ids = pd.Index(record_ids)
+        row_index = record_ids.get_indexer(sorted_by_record[record_id])
+        if (row_index == -1).any():
+            raise ValueError(f"Found {record_id} values that are not in record_ids")
+
+    mat = scipy.sparse.csr_matrix(
+        (np.ones(len(row_index), dtype=np.uint8), (row_index, column_index)),
+        shape=(len(record_ids), len(column_names)),
+    )
+    # The values are all 0/1, so store them as uint8. Make the fill
+    # value explicit (some pandas versions default to NaN for sparse
+    # columns, which would need a fillna)
     return pd.DataFrame.sparse.from_spmatrix(
         mat, index=record_ids, columns=column_names
+    ).astype(pd.SparseDtype(np.uint8, 0))
+
+
+def frame_to_csr(df):
+    """
+    Convert a dataframe which may contain a mix of dense and
+    sparse (pd.SparseDtype) columns to a float64 CSR matrix,
+    with columns in the same order as df. The sparse columns
+    are converted directly from their sparse representation,
+    so that they are never densified (df.to_numpy() would
+    allocate the full dense array for the thousands of
+    columns in the all-codes dataset). All dense columns
+    must be convertible to float.
+    """
+    is_sparse = np.array(
+        [isinstance(dtype, pd.SparseDtype) for dtype in df.dtypes], dtype=bool
+    )
+    dense = scipy.sparse.csr_matrix(df.loc[:, ~is_sparse].to_numpy(dtype=np.float64))
+    if not is_sparse.any():
+        return dense
+    sparse = df.loc[:, is_sparse].sparse.to_coo().astype(np.float64)
+
+    # Put the columns back in their original order
+    mat = scipy.sparse.hstack([dense, sparse], format="csc")
+    order = np.argsort(
+        np.concatenate([np.flatnonzero(~is_sparse), np.flatnonzero(is_sparse)]),
+        kind="stable",
     )
+    return mat[:, order].tocsr()
@@ -61,6 +61,7 @@ import numpy as np
 from sklearn.utils import resample
 import warnings
 import pandas as pd
+from joblib import Parallel, delayed
 
 
 def make_bootstrapped_resamples(X0_train, y0_train, M):
@@ -209,13 +210,20 @@ def plot_instability(ax, probs, y_test, title="Probability stability"):
     ax.set_ylabel("Bootstrap model predictions")
 
 
-def fit_model(Model, object_column_indices, X0_train, y0_train, M):
+def fit_model(Model, object_column_indices, X0_train, y0_train, M, n_jobs=-1):
     """
     Fit the model given in the first argument to the training data
     (X0_train, y0_train) to produce M0. Then resample the training data M times
     (with replacement) to obtain M new training sets (Xm_train, ym_train), and
     fit M other models Mn. return the pair (M0, Mm) (the second element is a list
     of length M).
+
+    The bootstrapped models are independent of each other, so they are
+    fitted in parallel in n_jobs worker processes (by default, one per
+    CPU; use n_jobs=1 to fit them one after the other). Each bootstrapped
+    model is fitted from scratch (not started from M0), so that an
+    unconverged fit cannot make the bootstrapped models look more similar
+    to M0 than they are.
     """
     # Develop a single model from the training set (X0_train, y0_train),
     # using any method (e.g. including cross validation and hyperparameter
@@ -231,7 +239,10 @@ def fit_model(Model, object_column_indices, X0_train, y0_train, M):
 
     # Develop all the bootstrap models to compare with the model-under-test M0
     print("Fitting bootstrapped models")
-    Mm = [Model(X, y, object_column_indices) for (X, y) in zip(Xm_train, ym_train)]
+    Mm = Parallel(n_jobs=n_jobs)(
+        delayed(Model)(X, y, object_column_indices)
+        for (X, y) in zip(Xm_train, ym_train)
+    )
 
     return (M0, Mm)
 
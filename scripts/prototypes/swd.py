@@ -1,7 +1,9 @@
 import sqlalchemy as sql
+import os
 import pandas as pd
 import time
 import numpy as np
+import raw_load
 
 def make_attributes_query(start_date, end_date, patient_ids):
     '''
@@ -234,7 +236,7 @@ def get_attributes_data(start_date, end_date, patient_ids, num_chunks = 10):
     count = 1
     for chunk in np.array_split(patient_ids, num_chunks):
         print(f"Fetching chunk {count} of {num_chunks}")
-        df = pd.read_sql(make_attributes_query(start_date, end_date, chunk), con)
+        df = raw_load.read_sql(make_attributes_query(start_date, end_date, chunk), con)
         raw_data_list.append(df)
         count += 1
     
@@ -245,23 +247,39 @@ def get_attributes_data(start_date, end_date, patient_ids, num_chunks = 10):
     print(f"Time to fetch attributes data: {stop - start}")
     return raw_data
 
-def get_raw_attributes_data(start_date, end_date, patient_ids, from_file):
+def get_raw_attributes_data(
+    start_date, end_date, patient_ids, from_file, datasets_dir="datasets"
+):
     """
     Fetch the patient attributes data from the primary_care_attributes table
     (onecare). Only obtain data for patients in the patient_ids list, which 
     corresponds to patients with index events. The start_date and end_date can
     be used to limit the date range (based on the attribute_period column).
     
-    If from_file = False, the data is fetched from SQL and saved to 
-    datasets/raw_attributes.pkl. If from_file = True, then all other parameters
-    are ignored and the data is read from that file
+    If from_file = False, the data is fetched from SQL and saved to
+    raw_attributes.parquet in datasets_dir (by default datasets/, relative
+    to the working directory). If from_file = True, then start_date and
+    end_date are ignored and the data is read from that file. In both cases,
+    only rows for patients in patient_ids are loaded (the filter is part of
+    the SQL query, or is applied by pyarrow while reading the Parquet file,
+    so that the other patients are never converted to pandas).
+
+    The patient_id column is converted to an integer (using the narrowest
+    integer type that fits), to match the patient_id in the episodes data.
     """
+    path = os.path.join(datasets_dir, "raw_attributes.parquet")
     if not from_file:
         print("Fetching attributes dataset from SQL")
         raw_attributes = get_attributes_data(start_date, end_date, patient_ids, 10)
-        raw_attributes.to_pickle("datasets/raw_attributes.pkl")
+        raw_attributes["patient_id"] = pd.to_numeric(
+            raw_attributes["patient_id"], downcast="integer"
+        )
+        raw_attributes.to_parquet(path, compression="zstd", row_group_size=100_000)
     else:
-        raw_attributes = pd.read_pickle("datasets/raw_attributes.pkl")
+        raw_attributes = pd.read_parquet(
+            path,
+            filters=[("patient_id", "in", [int(x) for x in patient_ids])],
+        )
         
     # Exclude any rows where NHSNumberWasValid is not equal to 1
     nhs_number_not_valid = raw_attributes["NHSNumberWasValid"] != 1
@@ -285,8 +303,11 @@ def get_raw_attributes_data(start_date, end_date, patient_ids, from_file):
     new_columns = ["swd_" + x if (x not in exclude) else x for x in raw_attributes.columns]
     raw_attributes.columns = new_columns
 
-    # Add an ID column to use for joining later
-    raw_attributes["attribute_id"] = raw_attributes.reset_index(drop=True).index    
+    # Add an ID column to use for joining later (downcast to the narrowest
+    # integer type that fits, because it is only used as a join key)
+    raw_attributes["attribute_id"] = pd.to_numeric(
+        raw_attributes.reset_index(drop=True).index, downcast="integer"
+    )
     
     return raw_attributes
     
@@ -0,0 +1,66 @@
+import numpy as np
+from sklearn.calibration import calibration_curve
+from calibration import (
+    get_prediction_bin_counts,
+    get_calibration_curve,
+    get_bootstrapped_calibration,
+)
+
+
+def test_prediction_bin_counts():
+    """
+    Check that the vectorised bin counts match np.histogram
+    applied to each column separately, including for
+    probabilities exactly equal to 0 and 1.
+    """
+    rng = np.random.default_rng(0)
+    n_bins = 10
+    probs = rng.random((100, 5))
+    probs[0, :] = 0
+    probs[1, :] = 1
+
+    freqs = get_prediction_bin_counts(probs, n_bins)
+    assert freqs.shape == (n_bins, probs.shape[1])
+
+    # The bins are computed in float32
+    probs = probs.astype(np.float32)
+    bin_edges = np.linspace(0, 1, n_bins + 1, dtype=np.float32)
+    for j in range(probs.shape[1]):
+        f, _ = np.histogram(probs[:, j], bins=bin_edges)
+        assert (freqs[:, j] == f).all()
+
+
+def test_calibration_curve():
+    """
+    Check that the calibration curve matches the sklearn
+    calibration_curve function, including when some bins
+    are empty.
+    """
+    rng = np.random.default_rng(1)
+    n_bins = 10
+    y_test = rng.integers(0, 2, 200)
+    prob = rng.random(200) * 0.7
+    prob[0] = 0.3
+
+    prob_true, prob_pred = get_calibration_curve(y_test, prob, n_bins)
+    expected_true, expected_pred = calibration_curve(y_test, prob, n_bins=n_bins)
+    assert np.allclose(prob_true, expected_true)
+    assert np.allclose(prob_pred, expected_pred)
+
+
+def test_bootstrapped_calibration():
+    """
+    Check that the calibration curves for several models
+    computed together match sklearn applied to each column.
+    """
+    rng = np.random.default_rng(2)
+    n_bins = 5
+    y_test = rng.integers(0, 2, 100)
+    probs = rng.random((100, 4)) * 0.6
+
+    curves = get_bootstrapped_calibration(probs, y_test, n_bins)
+    assert len(curves) == probs.shape[1]
+    for n, (x, y) in enumerate(curves):
+        expected_y, expected_x = calibration_curve(y_test, probs[:, n], n_bins=n_bins)
+        assert np.allclose(x, expected_x)
+        assert np.allclose(y, expected_y)
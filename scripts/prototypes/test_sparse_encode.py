@@ -1,3 +1,5 @@
+import pandas as pd
+import pytest
 import sparse_encode as spe
 
 def test_get_column_index():
@@ -25,3 +27,50 @@ def test_get_column_index():
     assert index == 0
     assert code_to_index["abc"] == 0  
 
+
+
+def test_sparse_encode():
+    '''
+    Check that the sparse encoding has one row per
+    record and one column per code (in order of first
+    appearance), that the record_ids argument adds
+    empty rows, and that duplicates raise ValueError.
+    '''
+    long_codes = pd.DataFrame(
+        {
+            "record": [2, 1, 1, 2],
+            "full_code": ["b", "a", "b", "c"],
+        }
+    )
+
+    df = spe.sparse_encode(long_codes, "record")
+    assert list(df.index) == [1, 2]
+    assert list(df.columns) == ["a", "b", "c"]
+    assert (df.sparse.to_dense().to_numpy() == [[1, 1, 0], [0, 1, 1]]).all()
+
+    df = spe.sparse_encode(long_codes, "record", [3, 2, 1])
+    assert list(df.index) == [3, 2, 1]
+    assert (df.sparse.to_dense().to_numpy() == [[0, 0, 0], [0, 1, 1], [1, 1, 0]]).all()
+
+    with pytest.raises(ValueError):
+        spe.sparse_encode(pd.concat([long_codes, long_codes]), "record")
+
+
+def test_frame_to_csr():
+    '''
+    Check that a frame with a mix of dense and sparse
+    columns is converted to a CSR matrix with the same
+    values and column order.
+    '''
+    df = pd.DataFrame(
+        {
+            "a": pd.arrays.SparseArray([0, 1, 0], fill_value=0),
+            "b": [1.5, 0.0, 2.0],
+            "c": pd.arrays.SparseArray([2, 0, 0], fill_value=0),
+            "d": [True, False, True],
+        }
+    )
+    mat = spe.frame_to_csr(df)
+    assert mat.format == "csr"
+    expected = [[0, 1.5, 2, 1], [1, 0, 0, 0], [0, 2, 0, 1]]
+    assert (mat.toarray() == expected).all()
@@ -0,0 +1,39 @@
+import numpy as np
+import scipy.sparse
+from transformers import RemoveMajorityZero
+
+
+def test_remove_majority_zero():
+    '''
+    Check that only the columns with a proportion of
+    nonzero entries above the threshold are kept, for
+    both dense and sparse feature matrices, and that
+    explicitly stored zeros are not counted (without
+    modifying the input).
+    '''
+    X = np.array(
+        [
+            [1, 0, 0, 2],
+            [1, 0, 3, 0],
+            [0, 0, 0, 4],
+            [1, 5, 0, 6],
+        ]
+    )
+    t = RemoveMajorityZero(0.3)
+    assert (t.fit_transform(X) == X[:, [0, 3]]).all()
+
+    X_sparse = scipy.sparse.csr_matrix(X)
+    assert (t.fit_transform(X_sparse).toarray() == X[:, [0, 3]]).all()
+
+    # Column 0 has one nonzero and one explicitly stored zero, so it
+    # is below the threshold (it would be kept if the stored zero were
+    # counted). Column 1 has two nonzeros, so it is kept.
+    X_explicit = scipy.sparse.csc_matrix(
+        (np.array([1, 0, 1, 1]), (np.array([0, 1, 0, 2]), np.array([0, 0, 1, 1]))),
+        shape=(4, 2),
+    )
+    assert X_explicit.nnz == 4
+    data_before = X_explicit.data.copy()
+    assert (t.fit_transform(X_explicit).toarray() == X_explicit.toarray()[:, [1]]).all()
+    assert X_explicit.nnz == 4
+    assert (X_explicit.data == data_before).all()
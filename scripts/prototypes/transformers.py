@@ -2,6 +2,8 @@
 #
 # Mainly for preprocessing features.
 
+import numpy as np
+import scipy.sparse
 from sklearn.base import BaseEstimator, TransformerMixin
 
 
@@ -15,6 +17,19 @@ def proportion_nonzero(column):
     return (column != 0).mean()
 
 
+def proportion_nonzero_columns(X):
+    """
+    Calculate the proportion of nonzero entries in each column
+    of X (a numpy array or a scipy sparse matrix), in one pass
+    over X. For a sparse matrix, only the stored entries are
+    read (explicitly stored zeros are not counted, and X is not
+    modified).
+    """
+    if scipy.sparse.issparse(X):
+        return np.asarray(X.count_nonzero(axis=0)).ravel() / X.shape[0]
+    return np.count_nonzero(X, axis=0) / X.shape[0]
+
+
 class RemoveMajorityZero(BaseEstimator, TransformerMixin):
     def __init__(self, mean_nonzero_threshold):
         """
@@ -32,12 +47,12 @@ class RemoveMajorityZero(BaseEstimator, TransformerMixin):
         non-zeros is high enough). Subsequent calls to
         transform will only keep these columns of X.
 
-        Testing: not yet tested
+        The proportions are calculated for all the columns at once
+        (see proportion_nonzero_columns), instead of column by column.
         """
-        self._columns_to_keep = []
-        for i, column in enumerate(X.T):
-            if proportion_nonzero(column) > self.mean_nonzero_threshold:
-                self._columns_to_keep.append(i)
+        self._columns_to_keep = np.flatnonzero(
+            proportion_nonzero_columns(X) > self.mean_nonzero_threshold
+        )
         return self
 
     def transform(self, X, y=None):